@@ -0,0 +1,223 @@
+"""
+Offline end-to-end benchmark: encoder, embedder round and search API.
+
+Everything runs in one process against a synthetic image set and the NumPy
+vector backend (common/numpy_store.py) standing in for Elasticsearch, so no
+containers or network are needed. With the default `--pretrained none` the
+CLIP weights are randomly initialised – throughput and latency are the same
+as with real weights, search quality is not measured.
+
+Reports
+* encoder  – images/s for encoder.images() per batch size, prompts/s for
+             encoder.text() per batch size
+* embedder – run_once() wall time on a cold corpus and on an unchanged
+             (warm) one
+* search   – /search/text p50/p95/p99 latency and req/s per concurrency
+             level (prompt/result caches missed, then hit), through the
+             ASGI app in-process; searches whatever the embedder indexed
+
+Usage (from the repo root, with embedder + search_api requirements and httpx)
+-----
+python bench/benchmark.py --images 256 --json bench-$(git rev-parse --short HEAD).json
+python bench/benchmark.py --only encoder --batch-sizes 1,8,32 --backend torch-int8
+"""
+from __future__ import annotations
+
+import argparse, asyncio, json, os, platform, random, subprocess, sys, tempfile, time
+from pathlib import Path
+
+import numpy as np
+
+ROOT     = Path(__file__).resolve().parent.parent
+SECTIONS = ("encoder", "embedder", "search")
+
+
+# ── helpers ---------------------------------------------------------------
+def percentiles(samples_ms: list[float]) -> dict:
+    p50, p95, p99 = np.percentile(samples_ms, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 2), "p95_ms": round(float(p95), 2), "p99_ms": round(float(p99), 2)}
+
+
+def make_images(out: Path, n: int, size: tuple[int, int], seed: int) -> list[Path]:
+    """Smooth random colour fields saved as JPEG – compress and decode like photos."""
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    out.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(n):
+        small = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+        img = Image.fromarray(small).resize(size, Image.BICUBIC)
+        path = out / f"synthetic_{i:05d}.jpg"
+        img.save(path, "JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except Exception:
+        return None
+
+
+# ── sections --------------------------------------------------------------
+def bench_encoder(paths: list[Path], batch_sizes: list[int], repeat: int) -> dict:
+    from common.models import encoder
+
+    encoder.load()
+    prompts = [f"a photo of synthetic object number {i}" for i in range(max(batch_sizes) * repeat)]
+    images, text = [], []
+    for bs in batch_sizes:
+        batch = paths[:bs]
+        encoder.images(batch)                                  # warm-up
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            encoder.images(batch)
+        elapsed = time.perf_counter() - t0
+        images.append({"batch_size": bs, "images_per_s": round(bs * repeat / elapsed, 2)})
+
+        encoder.text(prompts[:bs])
+        t0 = time.perf_counter()
+        for r in range(repeat):
+            encoder.text(prompts[r * bs:(r + 1) * bs])
+        elapsed = time.perf_counter() - t0
+        text.append({"batch_size": bs, "prompts_per_s": round(bs * repeat / elapsed, 2)})
+    return {"backend": encoder.backend, "images": images, "text": text}
+
+
+def bench_embedder() -> dict:
+    sys.path.insert(0, str(ROOT / "embedder"))
+    import worker                                              # module-level setup runs here
+
+    t0 = time.perf_counter()
+    cold = worker.run_once()
+    cold_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    warm = worker.run_once()
+    warm_s = time.perf_counter() - t0
+    return {
+        "cold": {"embedded": cold, "seconds": round(cold_s, 3),
+                 "images_per_s": round(cold / cold_s, 2) if cold else 0.0},
+        "warm": {"embedded": warm, "seconds": round(warm_s, 3)},
+    }
+
+
+async def _load(client, concurrency: int, requests: int, prompts: list[str], k: int) -> dict:
+    lat: list[float] = []
+    it = iter(prompts)
+
+    async def user():
+        for prompt in it:
+            t0 = time.perf_counter()
+            resp = await client.post("/search/text", json={"text": prompt, "k": k})
+            resp.raise_for_status()
+            lat.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    return {"concurrency": concurrency, "requests": requests,
+            "req_per_s": round(requests / elapsed, 2), **percentiles(lat)}
+
+
+async def _bench_search(levels: list[int], requests: int, k: int, seed: int) -> dict:
+    import httpx
+
+    sys.path.insert(0, str(ROOT / "search_api"))
+    from app import main
+
+    rng = random.Random(seed)
+    transport = httpx.ASGITransport(app=main.app)
+    rows = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await client.post("/search/text", json={"text": "warm-up", "k": k})
+        for c in levels:
+            # unique prompts: every request pays for encoding + kNN
+            fresh = [f"synthetic query {c}-{i}-{rng.random()}" for i in range(requests)]
+            rows.append({"cache": "miss", **await _load(client, c, requests, fresh, k)})
+            rows.append({"cache": "hit", **await _load(client, c, requests, fresh, k)})
+    await main.store.close_async()
+    return {"k": k, "levels": rows}
+
+
+def bench_search(levels: list[int], requests: int, k: int, seed: int) -> dict:
+    return asyncio.run(_bench_search(levels, requests, k, seed))
+
+
+# ── main ------------------------------------------------------------------
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--only", help=f"comma-separated subset of {','.join(SECTIONS)}")
+    ap.add_argument("--images", type=int, default=128, help="synthetic corpus size")
+    ap.add_argument("--image-size", default="640x480")
+    ap.add_argument("--batch-sizes", default="1,8,32")
+    ap.add_argument("--repeat", type=int, default=5, help="timed passes per batch size")
+    ap.add_argument("--concurrency", default="1,8,32", help="search load levels")
+    ap.add_argument("--requests", type=int, default=200, help="search requests per level")
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--model", default=os.getenv("MODEL", "RN50"))
+    ap.add_argument("--backend", default=os.getenv("ENCODER_BACKEND", "torch"),
+                    help="ENCODER_BACKEND: torch | torch-int8 | onnx")
+    ap.add_argument("--pretrained", default="none", help='OpenCLIP weights tag, "none" = offline')
+    ap.add_argument("--workdir", help="keep corpus and stores here (default: temp dir)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", help="write the results to this file")
+    args = ap.parse_args(argv)
+
+    sections = args.only.split(",") if args.only else list(SECTIONS)
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        ap.error(f"unknown section(s): {', '.join(sorted(unknown))}")
+
+    work = Path(args.workdir or tempfile.mkdtemp(prefix="image-search-bench-"))
+    images_dir = work / "images"
+    # configure every service module before it is imported
+    os.environ.update({
+        "MODEL":                args.model,
+        "ENCODER_BACKEND":      args.backend,
+        "ENCODER_TOWERS":       "both",
+        "PRETRAINED":           args.pretrained,
+        "DEVICE":               "cpu",
+        "VECTOR_BACKEND":       "numpy",
+        "VECTOR_DIR":           str(work / "vectors"),
+        "IMAGES_DIR":           str(images_dir),
+        "SPOOL_DIR":            str(images_dir / ".spool"),
+        "DERIVED_DIR":          str(images_dir / ".derived"),
+        "MANIFEST_PATH":        str(work / "state" / "manifest.sqlite"),
+        "EMBEDDING_CACHE_PATH": str(work / "state" / "embeddings.sqlite"),
+        "THUMB_DIR":            str(work / "thumbs"),
+    })
+    sys.path.insert(0, str(ROOT))
+
+    w, h = (int(x) for x in args.image_size.split("x"))
+    paths = make_images(images_dir, args.images, (w, h), args.seed)
+
+    results: dict = {
+        "commit":    git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host":      {"python": platform.python_version(), "machine": platform.machine(),
+                      "cpus": os.cpu_count()},
+        "config":    {k: v for k, v in vars(args).items() if k not in ("json", "workdir")},
+    }
+    batch_sizes = [min(int(b), len(paths)) for b in args.batch_sizes.split(",")]
+    if "encoder" in sections:
+        results["encoder"] = bench_encoder(paths, batch_sizes, args.repeat)
+    if "embedder" in sections:
+        results["embedder"] = bench_embedder()
+    if "search" in sections:
+        levels = [int(c) for c in args.concurrency.split(",")]
+        results["search"] = bench_search(levels, args.requests, args.k, args.seed)
+
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
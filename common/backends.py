@@ -0,0 +1,205 @@
+"""
+Pluggable vector-search backends.
+
+Callers talk to a `VectorBackend` instead of Elasticsearch directly, so the
+same embedder / search-api code can run against
+
+* "elasticsearch" – the default, HNSW index in ES (see common/es_utils.py)
+* "numpy"         – in-process exact search over a memory-mapped file
+                    (see common/numpy_store.py); no ES container needed
+
+Pick one with VECTOR_BACKEND.
+
+Usage
+-----
+from common.backends import get_backend
+store = get_backend()
+store.ensure_index()
+hits = store.knn_search(vec, k=10)
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+from abc import ABC, abstractmethod
+from contextlib import nullcontext
+from typing import ContextManager, Iterable
+
+from common import es_utils
+
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "elasticsearch").lower()
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# INTERFACE
+class VectorBackend(ABC):
+    """
+    Everything the services need from a vector store. Hits are always
+    {**source_fields, "id", "score"} dicts, best first.
+    """
+
+    name = "base"
+
+    # — write side (embedder) —
+    @abstractmethod
+    def ensure_index(self):
+        ...
+
+    @abstractmethod
+    def existing_ids(self, ids: list[str]) -> set[str]:
+        ...
+
+    @abstractmethod
+    def bulk_index(self, docs: Iterable[tuple[str, dict]], chunk_size: int = 500) -> list[str]:
+        ...
+
+    def bulk_mode(self) -> ContextManager[None]:
+        """Context for large backfills (e.g. refresh off). No-op by default."""
+        return nullcontext()
+
+    @abstractmethod
+    def target(self) -> str:
+        """Identifies the physical index; changes when it is rebuilt or replaced."""
+
+    def promote(self, part: int = 0, parts: int = 1):
+        """
+        Called by embedder shard `part` of `parts` after a clean full round:
+        an index built behind the live one (model switch) goes live once
+        every shard has filled it. No-op by default.
+        """
+
+    # — read side (search-api) —
+    # queries are (vector, k, candidates) or (vector, k, candidates, spec),
+    # spec being a normalized metadata filter (common/filters.py)
+    def knn_search(
+        self, vector: list[float], k: int = 10, candidates: int = 100,
+        source_fields: list[str] | None = None, spec: dict | None = None,
+    ) -> list[dict]:
+        return self.knn_msearch([(vector, k, candidates, spec)], source_fields)[0]
+
+    @abstractmethod
+    def knn_msearch(
+        self, queries: list[tuple],
+        source_fields: list[str] | None = None,
+    ) -> list[list[dict] | Exception]:
+        ...
+
+    # the sync calls may block (I/O, locks, big scans): keep them off the event loop
+    async def knn_msearch_async(
+        self, queries: list[tuple],
+        source_fields: list[str] | None = None,
+    ) -> list[list[dict] | Exception]:
+        return await asyncio.to_thread(self.knn_msearch, queries, source_fields)
+
+    @abstractmethod
+    def get_vectors(self, ids: list[str]) -> dict[str, list[float]]:
+        """Stored vectors by document id; unknown ids are left out."""
+
+    async def get_vectors_async(self, ids: list[str]) -> dict[str, list[float]]:
+        return await asyncio.to_thread(self.get_vectors, ids)
+
+    @abstractmethod
+    async def generation_async(self) -> tuple:
+        """Fingerprint that changes whenever documents are added or removed."""
+
+    @abstractmethod
+    async def info_async(self) -> dict:
+        """{"backend", "version", "doc_count", "status", "index_options"} for /meta."""
+
+    async def close_async(self):
+        pass
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# ELASTICSEARCH
+class ElasticsearchBackend(VectorBackend):
+    """Thin adapter over the helpers in common/es_utils.py."""
+
+    name = "elasticsearch"
+
+    def __init__(self, index: str = es_utils.ES_INDEX):
+        self.index = index
+        self.write = index                  # a staged index while a model switch fills it
+        self.es    = es_utils.get_es_client()
+        self._aes  = None
+
+    @property
+    def aes(self):
+        # created lazily: AsyncElasticsearch wants to live on the running loop
+        if self._aes is None:
+            self._aes = es_utils.get_async_es_client()
+        return self._aes
+
+    def ensure_index(self):
+        self.write = es_utils.ensure_index_exists(self.es, self.index)
+
+    def existing_ids(self, ids: list[str]) -> set[str]:
+        return es_utils.existing_ids(self.es, self.write, ids)
+
+    def bulk_index(self, docs: Iterable[tuple[str, dict]], chunk_size: int = 500) -> list[str]:
+        return es_utils.bulk_index(self.es, self.write, docs, chunk_size)
+
+    def bulk_mode(self) -> ContextManager[None]:
+        return es_utils.refresh_disabled(self.es, self.write)
+
+    def target(self) -> str:
+        if self.es.indices.exists_alias(name=self.write):
+            return ",".join(sorted(self.es.indices.get_alias(name=self.write)))
+        return self.write
+
+    def promote(self, part: int = 0, parts: int = 1):
+        if self.write != self.index and es_utils.promote_staged(self.es, self.index, self.write, part, parts):
+            self.write = self.index
+
+    def knn_search(self, vector, k=10, candidates=100, source_fields=None, spec=None):
+        return es_utils.knn_search(
+            self.es, self.index, vector, k=k, candidates=candidates,
+            source_fields=source_fields, spec=spec,
+        )
+
+    def knn_msearch(self, queries, source_fields=None):
+        return [
+            self.knn_search(vec, k, candidates, source_fields, *spec)
+            for vec, k, candidates, *spec in queries
+        ]
+
+    async def knn_msearch_async(self, queries, source_fields=None):
+        return await es_utils.knn_msearch_async(self.aes, self.index, queries, source_fields)
+
+    def get_vectors(self, ids):
+        return es_utils.get_vectors(self.es, self.index, ids)
+
+    async def get_vectors_async(self, ids):
+        return await es_utils.get_vectors_async(self.aes, self.index, ids)
+
+    async def generation_async(self) -> tuple:
+        return await es_utils.index_generation_async(self.aes, self.index)
+
+    async def info_async(self) -> dict:
+        info, health, count, options = await asyncio.gather(
+            self.aes.info(), self.aes.cluster.health(), self.aes.count(index=self.index),
+            es_utils.vector_options_async(self.aes, self.index),
+        )
+        return {
+            "backend":       self.name,
+            "version":       info["version"]["number"],
+            "doc_count":     count["count"],
+            "status":        health["status"],
+            "index_options": options,
+        }
+
+    async def close_async(self):
+        if self._aes is not None:
+            await self._aes.close()
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# FACTORY
+def get_backend(name: str = VECTOR_BACKEND) -> VectorBackend:
+    """Return the backend selected by VECTOR_BACKEND (one per process)."""
+    if name == "elasticsearch":
+        return ElasticsearchBackend()
+    if name == "numpy":
+        from common.numpy_store import NumpyBackend      # numpy only needed here
+        return NumpyBackend()
+    raise ValueError(f"Unknown VECTOR_BACKEND {name!r}, must be 'elasticsearch' or 'numpy'")
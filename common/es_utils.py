@@ -2,50 +2,204 @@
 Utilities shared functions by downloader / embedder / search-api.
 """
 import os
+import re
+import time
 import logging
-from elasticsearch import Elasticsearch, ConnectionError, TransportError, BadRequestError
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+from elasticsearch import (
+    AsyncElasticsearch, Elasticsearch, ConnectionError, TransportError, BadRequestError,
+    NotFoundError,
+)
+from elasticsearch.helpers import streaming_bulk
 from common.models import encoder
+from common import filters
 
 # ────────────────────────────────────────────────────────────────────────────────
 # CONFIG
 ES_HOST   = os.getenv("ES_HOST", "http://es:9200")   # overridable in compose
 ES_INDEX  = os.getenv("ES_INDEX", "images")
 TIMEOUT_S = int(os.getenv("ES_TIMEOUT", 30))
+POOL_SIZE = int(os.getenv("ES_POOL_SIZE", 32))      # HTTP connections per node (async client)
+BULK_RETRIES     = int(os.getenv("ES_BULK_RETRIES", 6))        # per chunk / doc on 429
+BULK_BACKOFF_S   = float(os.getenv("ES_BULK_BACKOFF", 2))      # first retry delay, doubles
 
+# vector index – hnsw | int8_hnsw | int4_hnsw | bbq_hnsw (quantized types need newer ES)
+INDEX_TYPE = os.getenv("ES_INDEX_TYPE", "hnsw")
+HNSW_M     = int(os.getenv("HNSW_M", 16))
+HNSW_EF    = int(os.getenv("HNSW_EF", 512))           # ef_construction
+# >0 → fetch k × oversample candidates and re-rank them on full-precision vectors
+RESCORE_OVERSAMPLE = float(os.getenv("ES_RESCORE_OVERSAMPLE", 0))
 
 
-def ensure_index_exists(es: Elasticsearch, index: str = ES_INDEX):
-    # grab the current encoder’s dimension
-    dim = encoder.embed_dim
+def vector_mapping(dim: int) -> dict:
+    """`dense_vector` mapping for `vector`, built from the settings above."""
+    return {
+        "type": "dense_vector",
+        "dims": dim,
+        "index": True,
+        "similarity": "cosine",
+        "index_options": {"type": INDEX_TYPE, "m": HNSW_M, "ef_construction": HNSW_EF},
+    }
+
 
-    mapping = {
+def index_body(dim: int, model: str | None = None) -> dict:
+    return {
       "mappings": {
+        "_meta": {"model": model or encoder.name},   # which embedding space the vectors are in
         "properties": {
           "path": {"type": "keyword"},
-          "vector": {
-            "type": "dense_vector",
-            "dims": dim,
-            "index": True,
-            "similarity": "cosine",
-            "index_options": {"type": "hnsw", "m": 16, "ef_construction": 512},
-          },
+          "vector": vector_mapping(dim),
+          **filters.mapping_properties(),       # metadata for kNN pre-filters
         }
       }
     }
 
+
+def _slug(model: str | None = None) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", (model or encoder.name).lower()).strip("-")
+
+
+def versioned_index_name(alias: str = ES_INDEX, model: str | None = None) -> str:
+    """e.g. images_vit-b-32_1760700000 – the concrete index behind `alias`."""
+    return f"{alias}_{_slug(model)}_{int(time.time())}"
+
+
+def create_versioned_index(
+    es: Elasticsearch, alias: str = ES_INDEX, dim: int | None = None, exist_ok: bool = False,
+) -> str:
+    """
+    Create the next versioned index for `alias`. With `exist_ok`, an index
+    another process created under the same name (same second) is taken as is.
+    """
+    name = versioned_index_name(alias)
+    try:
+        es.indices.create(index=name, body=index_body(dim or encoder.embed_dim))
+    except BadRequestError as exc:
+        if not (exist_ok and exc.error == "resource_already_exists_exception"):
+            raise
+    return name
+
+
+def is_concrete_index(es: Elasticsearch, name: str) -> bool:
+    """True for a legacy deployment where `name` is a plain index, not an alias."""
+    return bool(es.indices.exists(index=name)) and not es.indices.exists_alias(name=name)
+
+
+def swap_alias(es: Elasticsearch, alias: str, new_index: str) -> list[str]:
+    """
+    Atomically point `alias` at `new_index` (one `_aliases` call, so readers
+    never see a missing index). Returns the indices it was taken from.
+    A concrete index still named `alias` (pre-alias deployments) is deleted
+    in the same call – ES cannot add an alias that shares an index's name.
+    """
+    old = list(es.indices.get_alias(name=alias)) if es.indices.exists_alias(name=alias) else []
+    actions = [{"remove": {"index": i, "alias": alias}} for i in old if i != new_index]
+    if not old and is_concrete_index(es, alias):
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": new_index, "alias": alias, "is_write_index": True}})
+    es.indices.update_aliases(actions=actions)
+    return [i for i in old if i != new_index]
+
+
+def staged_index(es: Elasticsearch, alias: str = ES_INDEX) -> str | None:
+    """
+    The versioned index being filled for the current model while `alias`
+    still serves another one (see ensure_index_exists), oldest first so every
+    process settles on the same one.
+    """
+    names = es.indices.get(index=f"{alias}_{_slug()}_*", allow_no_indices=True, expand_wildcards="open")
+    live = set(es.indices.get_alias(name=alias)) if es.indices.exists_alias(name=alias) else set()
+    staged = sorted(n for n in names if n not in live)
+    return staged[0] if staged else None
+
+
+def promote_staged(es: Elasticsearch, alias: str, staged: str, part: int = 0, parts: int = 1) -> bool:
+    """
+    Record that embedder shard `part` of `parts` has filled `staged`. Once
+    every shard has (each leaves a `<staged>-filled-<part>-of-<parts>` alias
+    on it), swap `alias` over to it and delete the index it replaces.
+    Returns True once `staged` is live.
+    """
+    if es.indices.exists_alias(index=staged, name=alias):
+        return True                               # promoted by another shard
+    marks = {f"{staged}-filled-{i}-of-{parts}" for i in range(parts)}
+    es.indices.put_alias(index=staged, name=f"{staged}-filled-{part}-of-{parts}")
+    if not marks <= set(es.indices.get_alias(index=staged)[staged]["aliases"]):
+        return False
+    es.indices.refresh(index=staged)
+    old = swap_alias(es, alias, staged)
+    logging.info("Alias %s → %s (was %s)", alias, staged, ", ".join(old) or "–")
+    try:
+        for index in old:
+            es.indices.delete(index=index)
+        es.indices.delete_alias(index=staged, name=",".join(sorted(marks)))
+    except NotFoundError:
+        pass                                      # another shard promoted at the same time
+    return True
+
+
+def ensure_index_exists(es: Elasticsearch, index: str = ES_INDEX) -> str:
+    """
+    Make sure `index` resolves to an index built by the current encoder –
+    same model (mapping `_meta`) and vector dims. `index` is an alias over
+    versioned indices (see versioned_index_name); a legacy concrete index is
+    kept as long as it matches. Returns the index to write to: `index`
+    itself, or after a model switch a staged index that `index` keeps hiding
+    until the embedder has filled it (promote_staged).
+    """
+    # grab the current encoder’s dimension
+    dim = encoder.embed_dim
+    wanted = vector_mapping(dim)["index_options"]
+
     if es.indices.exists(index=index):
-        # fetch the existing mapping to see its dims
-        old_map = es.indices.get_mapping(index=index)
-        # drill down to the `dims` field
-        old_dims = old_map[index]["mappings"]["properties"]["vector"]["dims"]
-        if old_dims == dim:
-            # perfect — nothing to do
-            return
-        # mismatch! delete & recreate
-        es.indices.delete(index=index)
-
-    # either it didn’t exist, or we just deleted it
-    es.indices.create(index=index, body=mapping)
+        # fetch the existing mapping (keyed by the concrete index name)
+        old_map = next(iter(es.indices.get_mapping(index=index).values()))["mappings"]
+        old_vec = old_map["properties"]["vector"]
+        model = old_map.get("_meta", {}).get("model")
+        if model is None and old_vec["dims"] == dim:
+            # indices from before the model was recorded: adopt them
+            es.indices.put_mapping(index=index, meta={"model": encoder.name})
+            model = encoder.name
+        if old_vec["dims"] == dim and model == encoder.name:
+            # same model — keep the data, but say so if the HNSW options differ
+            if old_vec.get("index_options") != wanted:
+                logging.warning(
+                    "Index %s keeps index_options %s (configured %s) – "
+                    "run `python -m reindex` in the embedder to apply",
+                    index, old_vec.get("index_options"), wanted,
+                )
+            # metadata fields are additive: older indices just gain them
+            try:
+                es.indices.put_mapping(index=index, properties=filters.mapping_properties())
+            except BadRequestError as exc:
+                logging.warning("Cannot add metadata fields to %s → %s", index, exc)
+            return index
+        # model switch: fill a new index while `index` keeps serving the old
+        # one. The embedder refills it from its embedding cache where it can.
+        staged = staged_index(es, index)
+        if staged is None:
+            # processes starting together may each create one: all keep the oldest
+            mine = create_versioned_index(es, index, dim, exist_ok=True)
+            staged = staged_index(es, index)
+            if staged != mine:
+                es.indices.delete(index=mine)
+        logging.warning(
+            "Index %s holds %s vectors – writing %s vectors to %s, which replaces it once filled",
+            index, model or f"{old_vec['dims']}-dim", encoder.name, staged,
+        )
+        return staged
+
+    # first start: versioned index behind the alias. search-api and every
+    # embedder shard get here at boot; the last swap wins and drops the
+    # indices the others created (all still empty)
+    for stale in swap_alias(es, index, create_versioned_index(es, index, dim, exist_ok=True)):
+        try:
+            es.indices.delete(index=stale)
+        except NotFoundError:
+            pass
+    return index
 
 # ────────────────────────────────────────────────────────────────────────────────
 # CLIENT FACTORY
@@ -68,8 +222,74 @@ def get_es_client() -> Elasticsearch:
     return es
 
 
+def get_async_es_client() -> AsyncElasticsearch:
+    """
+    Return an AsyncElasticsearch client backed by a pooled aiohttp session.
+    Create it once per process (no ping here – there is no running loop yet)
+    and `await es.close()` on shutdown.
+    """
+    return AsyncElasticsearch(
+        hosts=[ES_HOST],
+        request_timeout=TIMEOUT_S,
+        max_retries=3,
+        retry_on_timeout=True,
+        connections_per_node=POOL_SIZE,
+    )
+
+
 # ────────────────────────────────────────────────────────────────────────────────
 # HELPER FOR K-NN QUERIES
+def _knn_request(
+    vector: list[float], k: int, candidates: int, source_fields: list[str],
+    spec: dict | None = None,
+) -> dict:
+    """
+    `_search` body for one kNN query. With RESCORE_OVERSAMPLE set, HNSW
+    returns k × oversample (possibly quantized) candidates and a
+    script_score rescore re-ranks them on the stored float vectors. A filter
+    spec (common/filters.py) becomes a kNN pre-filter.
+    """
+    fetch = max(k, int(k * RESCORE_OVERSAMPLE)) if RESCORE_OVERSAMPLE else k
+    body = {
+        "knn": {
+            "field": "vector",
+            "query_vector": vector,
+            "k": fetch,
+            "num_candidates": max(candidates, fetch),
+        },
+        "size": k,
+        "_source": source_fields,
+    }
+    if spec:
+        body["knn"]["filter"] = filters.to_es(spec)
+    if RESCORE_OVERSAMPLE:
+        body["rescore"] = {
+            "window_size": fetch,
+            "query": {
+                "rescore_query": {
+                    "script_score": {
+                        "query": {"match_all": {}},
+                        "script": {
+                            # same (1 + cos) / 2 scale as the kNN score
+                            "source": "(cosineSimilarity(params.q, 'vector') + 1.0) / 2.0",
+                            "params": {"q": vector},
+                        },
+                    },
+                },
+                "query_weight": 0,
+                "rescore_query_weight": 1,
+            },
+        }
+    return body
+
+
+def _hits(resp) -> list[dict]:
+    return [
+        {**hit["_source"], "id": hit["_id"], "score": hit["_score"]}
+        for hit in resp["hits"]["hits"]
+    ]
+
+
 def knn_search(
     es: Elasticsearch,
     index: str,
@@ -77,23 +297,196 @@ def knn_search(
     k: int = 10,
     candidates: int = 100,
     source_fields: list[str] | None = None,
+    spec: dict | None = None,
 ):
     """
-    Convenience wrapper around es.knn_search().
+    Convenience wrapper around a kNN `_search`.
     Returns a list of {id, score, ..._source} dicts.
     """
     source_fields = source_fields or ["path"]
-    resp = es.knn_search(
+    resp = es.search(index=index, **_knn_request(vector, k, candidates, source_fields, spec))
+    return _hits(resp)
+
+
+async def knn_search_async(
+    es: AsyncElasticsearch,
+    index: str,
+    vector: list[float],
+    k: int = 10,
+    candidates: int = 100,
+    source_fields: list[str] | None = None,
+    spec: dict | None = None,
+):
+    """Same as knn_search(), for AsyncElasticsearch clients."""
+    source_fields = source_fields or ["path"]
+    resp = await es.search(index=index, **_knn_request(vector, k, candidates, source_fields, spec))
+    return _hits(resp)
+
+
+async def knn_msearch_async(
+    es: AsyncElasticsearch,
+    index: str,
+    queries: list[tuple],
+    source_fields: list[str] | None = None,
+) -> list[list[dict] | Exception]:
+    """
+    Run many (vector, k, candidates[, filter spec]) kNN queries in one
+    `_msearch` round trip. Returns one hit list per query, or an exception
+    for queries that failed.
+    """
+    source_fields = source_fields or ["path"]
+    searches: list[dict] = []
+    for vector, k, candidates, *spec in queries:
+        searches.append({"index": index})
+        searches.append(_knn_request(vector, k, candidates, source_fields, *spec))
+    resp = await es.msearch(searches=searches)
+    return [
+        RuntimeError(f"msearch query failed → {r['error']}") if "error" in r else _hits(r)
+        for r in resp["responses"]
+    ]
+
+
+def exact_search(
+    es: Elasticsearch,
+    index: str,
+    vector: list[float],
+    k: int = 10,
+    source_fields: list[str] | None = None,
+) -> list[dict]:
+    """
+    Brute-force cosine top-k via `script_score` – scans every document, so
+    only use it as ground truth (recall measurements), never on the hot path.
+    """
+    source_fields = source_fields or ["path"]
+    resp = es.search(
         index=index,
-        knn={
-            "field": "vector",
-            "query_vector": vector,
-            "k": k,
-            "num_candidates": candidates,
-        },
+        size=k,
         _source=source_fields,
+        query={
+            "script_score": {
+                "query": {"match_all": {}},
+                "script": {
+                    "source": "(cosineSimilarity(params.q, 'vector') + 1.0) / 2.0",
+                    "params": {"q": vector},
+                },
+            },
+        },
     )
-    return [
-        {**hit["_source"], "id": hit["_id"], "score": hit["_score"]}
-        for hit in resp["hits"]["hits"]
-    ]
+    return _hits(resp)
+
+
+def sample_vectors(es: Elasticsearch, index: str, n: int, seed: int = 0) -> list[tuple[str, list[float]]]:
+    """Return up to `n` random (id, stored vector) pairs from the index."""
+    resp = es.search(
+        index=index,
+        size=n,
+        _source=["vector"],
+        query={"function_score": {"random_score": {"seed": seed, "field": "_seq_no"}}},
+    )
+    return [(hit["_id"], hit["_source"]["vector"]) for hit in resp["hits"]["hits"]]
+
+
+async def vector_options_async(es: AsyncElasticsearch, index: str) -> dict:
+    """`index_options` of the live `vector` mapping (what the index really uses)."""
+    resp = await es.indices.get_mapping(index=index)
+    vec = next(iter(resp.values()))["mappings"]["properties"]["vector"]   # alias → concrete name
+    return vec.get("index_options", {})
+
+
+async def index_generation_async(es: AsyncElasticsearch, index: str) -> tuple[int, int, int, int]:
+    """
+    Cheap fingerprint of the index contents: (docs, deleted docs, index ops,
+    refreshes). Changes whenever a document is written or removed, and again
+    when a refresh makes it visible to search.
+    """
+    stats = await es.indices.stats(index=index, metric="docs,indexing,refresh")
+    prim = stats["_all"]["primaries"]
+    return (
+        prim["docs"]["count"],
+        prim["docs"]["deleted"],
+        prim["indexing"]["index_total"],
+        prim["refresh"]["total"],
+    )
+
+# ────────────────────────────────────────────────────────────────────────────────
+# BULK HELPERS
+def _vectors(resp) -> dict[str, list[float]]:
+    return {doc["_id"]: doc["_source"]["vector"] for doc in resp["docs"] if doc.get("found")}
+
+
+def get_vectors(es: Elasticsearch, index: str, ids: list[str]) -> dict[str, list[float]]:
+    """Stored vectors for `ids` in one `_mget` (ids that are not indexed are left out)."""
+    if not ids:
+        return {}
+    return _vectors(es.mget(index=index, ids=ids, _source=["vector"]))
+
+
+async def get_vectors_async(es: AsyncElasticsearch, index: str, ids: list[str]) -> dict[str, list[float]]:
+    if not ids:
+        return {}
+    return _vectors(await es.mget(index=index, ids=ids, _source=["vector"]))
+
+
+def existing_ids(es: Elasticsearch, index: str, ids: list[str]) -> set[str]:
+    """
+    Return the subset of `ids` that already exist in `index`, using one
+    `_mget` round trip (no `_source` is transferred).
+    """
+    if not ids:
+        return set()
+    resp = es.mget(index=index, ids=ids, _source=False)
+    return {doc["_id"] for doc in resp["docs"] if doc.get("found")}
+
+
+def bulk_index(
+    es: Elasticsearch,
+    index: str,
+    docs: Iterable[tuple[str, dict]],
+    chunk_size: int = 500,
+) -> list[str]:
+    """
+    Write (id, document) pairs through `streaming_bulk`.
+    Returns the ids that were indexed; failures are logged, not raised.
+    A rejected chunk or document (429, ES indexing back-pressure) is retried
+    up to BULK_RETRIES times with exponential backoff from BULK_BACKOFF_S.
+    """
+    actions = (
+        {"_op_type": "index", "_index": index, "_id": doc_id, "_source": doc}
+        for doc_id, doc in docs
+    )
+    indexed: list[str] = []
+    for ok, item in streaming_bulk(
+        es, actions, chunk_size=chunk_size, raise_on_error=False,
+        max_retries=BULK_RETRIES, initial_backoff=BULK_BACKOFF_S, max_backoff=120,
+        retry_on_status=(429,),
+    ):
+        if ok:
+            indexed.append(item["index"]["_id"])
+        else:
+            logging.error("Bulk index failed → %s", item)
+    return indexed
+
+
+@contextmanager
+def refresh_disabled(es: Elasticsearch, index: str) -> Iterator[None]:
+    """
+    Turn off periodic refresh for the duration of a large backfill, then
+    restore the previous interval and refresh once so new docs are searchable.
+    A stored "-1" is left over from a backfill that was killed before it could
+    restore it, so the default (null) is put back instead.
+    """
+    settings = es.indices.get_settings(index=index, name="index.refresh_interval")
+    previous = (
+        next(iter(settings.values()), {}).get("settings", {})   # alias → concrete name
+        .get("index", {}).get("refresh_interval")
+    )
+    if previous == "-1":
+        previous = None
+    es.indices.put_settings(index=index, settings={"index": {"refresh_interval": "-1"}})
+    try:
+        yield
+    finally:
+        es.indices.put_settings(
+            index=index, settings={"index": {"refresh_interval": previous}},
+        )
+        es.indices.refresh(index=index)
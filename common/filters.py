@@ -0,0 +1,83 @@
+"""
+Metadata filters for kNN queries, shared by both vector backends.
+
+The embedder indexes a few cheap fields next to each vector (see FIELDS).
+A filter spec maps a field to either a list of accepted values or a range:
+
+    {"domain": ["example.com"], "width": {"gte": 512}, "indexed_at": {"gte": 1760000000}}
+
+Elasticsearch applies it as a kNN pre-filter (HNSW only visits matching
+docs); the NumPy backend scans just the matching rows.
+"""
+from __future__ import annotations
+
+import json, operator
+
+# field → ES type; indexed_at is epoch seconds
+FIELDS = {
+    "url":        "keyword",
+    "domain":     "keyword",
+    "width":      "integer",
+    "height":     "integer",
+    "bytes":      "long",
+    "indexed_at": "date",
+}
+_RANGE = {"gte": operator.ge, "gt": operator.gt, "lte": operator.le, "lt": operator.lt}
+
+
+def mapping_properties() -> dict:
+    return {
+        field: {"type": t, **({"format": "epoch_second"} if t == "date" else {})}
+        for field, t in FIELDS.items()
+    }
+
+
+def normalize(spec: dict | None) -> dict | None:
+    """Validate a spec and put it in canonical form; None when it filters nothing."""
+    if not spec:
+        return None
+    out: dict = {}
+    for field, cond in sorted(spec.items()):
+        if field not in FIELDS:
+            raise ValueError(f"Cannot filter on {field!r}, must be one of {sorted(FIELDS)}")
+        if isinstance(cond, dict):
+            bad = set(cond) - set(_RANGE)
+            if bad or not cond:
+                raise ValueError(f"Range on {field!r} takes gte/gt/lte/lt, got {sorted(cond)}")
+            if not all(isinstance(v, (int, float)) for v in cond.values()):
+                raise ValueError(f"Range bounds on {field!r} must be numbers")
+            out[field] = dict(sorted(cond.items()))
+        else:
+            values = cond if isinstance(cond, list) else [cond]
+            if not values:
+                raise ValueError(f"Empty value list for {field!r}")
+            out[field] = sorted(values, key=str)
+    return out
+
+
+def key(spec: dict | None) -> str:
+    """Hashable cache-key form of a normalized spec."""
+    return json.dumps(spec, sort_keys=True) if spec else ""
+
+
+def to_es(spec: dict) -> dict:
+    """The spec as an ES bool filter (for `knn.filter`)."""
+    clauses = [
+        {"range": {field: cond}} if isinstance(cond, dict) else {"terms": {field: cond}}
+        for field, cond in spec.items()
+    ]
+    return {"bool": {"filter": clauses}}
+
+
+def matches(doc: dict, spec: dict) -> bool:
+    """In-process equivalent of to_es(); docs without the field never match."""
+    for field, cond in spec.items():
+        value = doc.get(field)
+        if value is None:
+            return False
+        if isinstance(cond, dict):
+            if not all(_RANGE[op](value, bound) for op, bound in cond.items()):
+                return False
+        elif value not in cond:
+            return False
+    return True
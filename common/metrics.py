@@ -0,0 +1,105 @@
+"""
+Prometheus instrumentation shared by every service.
+
+* stage("name")   – context manager timing one hot-path stage into the
+                    `image_search_stage_seconds{stage}` histogram (and into the
+                    current request trace, if there is one)
+* start_trace()   – per-request trace: an id plus per-stage wall time, so a
+                    slow request can be logged with its breakdown
+* serve()         – sidecar HTTP server exposing /metrics for the workers
+                    (embedder, downloader); search-api serves its own route
+* latest()        – the exposition text for such a route
+
+Each process is its own scrape target, so no "service" label is needed –
+except the forked search-api workers (search_api/app/serve.py): they share
+PROMETHEUS_MULTIPROC_DIR and latest() sums them up.
+
+Usage
+-----
+from common import metrics
+with metrics.stage("decode"):
+    img = Image.open(path)
+"""
+from __future__ import annotations
+
+import contextvars, logging, os, time, uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+from prometheus_client import (                                  # noqa: F401 – re-exported
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest,
+    multiprocess, start_http_server,
+)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))                # sidecar port, 0 = off
+
+# 1 ms … 30 s: covers a cached lookup up to a cold CPU forward pass
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+STAGE_SECONDS = Histogram(
+    "image_search_stage_seconds", "Wall time of one hot-path stage", ["stage"], buckets=BUCKETS,
+)
+STAGE_ITEMS = Counter(
+    "image_search_stage_items_total", "Items (images, prompts, docs) handled per stage", ["stage"],
+)
+
+
+class Trace:
+    """Per-request id and stage timings, filled in by stage()."""
+
+    __slots__ = ("id", "stages", "t0")
+
+    def __init__(self, trace_id: str | None = None):
+        self.id     = trace_id or uuid.uuid4().hex[:16]
+        self.stages: dict[str, float] = {}
+        self.t0     = time.perf_counter()
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.t0) * 1000
+
+    def breakdown(self) -> str:
+        return " ".join(f"{k}={v * 1000:.1f}ms" for k, v in self.stages.items())
+
+
+_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace(trace_id: str | None = None) -> Trace:
+    trace = Trace(trace_id)
+    _trace.set(trace)
+    return trace
+
+
+def current_trace() -> Trace | None:
+    return _trace.get()
+
+
+@contextmanager
+def stage(name: str, items: int = 1, trace: bool = True) -> Iterator[None]:
+    """Time the block; `trace=False` for shared work (a batch serving many requests)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        STAGE_SECONDS.labels(name).observe(elapsed)
+        STAGE_ITEMS.labels(name).inc(items)
+        current = _trace.get() if trace else None
+        if current is not None:
+            current.stages[name] = current.stages.get(name, 0.0) + elapsed
+
+
+def latest() -> bytes:
+    """/metrics body: this process, or every process sharing PROMETHEUS_MULTIPROC_DIR."""
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def serve(port: int = METRICS_PORT):
+    """Start the /metrics sidecar on `port` (no-op when 0)."""
+    if port:
+        start_http_server(port)
+        logging.info("Metrics on :%d/metrics", port)
@@ -7,12 +7,35 @@ Usage
 from common.models import encoder          # singleton
 vec1 = encoder.text("a red vintage car")   # list[float] of length `embed_dim`
 vec2 = encoder.image(pil_image)            # list[float] of length `embed_dim`
+vecs = encoder.images([img_a, img_b])      # list[list[float]], one forward pass
+
+The singleton is lazy: importing it costs nothing, `encoder.embed_dim` is
+read from the OpenCLIP model config, and weights load on first real use.
+ENCODER_TOWERS=image|text keeps only one tower resident (the embedder never
+encodes text; a text-only search service never encodes images).
+
+ENCODER_BACKEND picks the CPU inference path: "torch" (fp32 eager),
+"torch-int8" (dynamic int8 Linear layers) or "onnx" (ONNX Runtime, towers
+exported once and cached in ONNX_CACHE_DIR). INTRA_OP_THREADS caps
+intra-op threads.
+torch-int8 only touches nn.Linear: the image tower of the ResNet models
+(RN50, the default) is convolutions plus an attention pool that cannot be
+quantized, so it runs – bit-identically – as fp32 and the embedder gains
+nothing; use onnx there. Text towers and ViT image towers do speed up.
+PRETRAINED names the OpenCLIP weights tag; "none" initialises randomly –
+no download, for offline benchmarks – from a fixed seed, so every load
+(fp32 reference, int8, ONNX export, other processes) has the same weights.
+Check drift against fp32 with `python -m common.models --parity`.
 '''
 
 from __future__ import annotations
 
 import os
 import io
+import logging
+import shutil
+import tempfile
+import threading
 from pathlib import Path
 from typing import Iterable, List, Union
 
@@ -20,14 +43,61 @@ import torch
 import open_clip                            # pip install open_clip_torch
 from PIL import Image
 
+from common.metrics import stage
+
 # ───────────────────────────────────────────────────────────── load_model
-_MODEL_CACHE: dict[tuple[str, str], tuple[open_clip.model.CLIP, callable]] = {}
+TOWERS   = ("both", "image", "text")
+BACKENDS = ("torch", "torch-int8", "onnx")
+
+ENCODER_BACKEND  = os.getenv("ENCODER_BACKEND", "torch")
+INTRA_OP_THREADS = int(os.getenv("INTRA_OP_THREADS", 0))      # 0 = library default
+PRETRAINED       = os.getenv("PRETRAINED", "openai")             # "none" = random init
+ONNX_CACHE_DIR   = Path(os.getenv("ONNX_CACHE_DIR", Path.home() / ".cache" / "image-search" / "onnx"))
+
+_MODEL_CACHE: dict[tuple[str, str, str, bool], tuple[open_clip.model.CLIP, callable]] = {}
+_DIM_CACHE: dict[str, int] = {}
+
+
+def model_embed_dim(name: str) -> int:
+    """Embedding size from the model's JSON config – no weights are loaded."""
+    if name not in _DIM_CACHE:
+        cfg = open_clip.get_model_config(name)
+        if cfg is None:
+            raise ValueError(f"Unknown model {name!r}, must be one of {open_clip.list_models()}")
+        _DIM_CACHE[name] = cfg["embed_dim"]
+    return _DIM_CACHE[name]
+
+
+def _drop_tower(model, keep: str):
+    """Release the weights of the tower we will never call."""
+    if keep == "image":
+        if hasattr(model, "text"):                      # CustomTextCLIP
+            model.text = None
+        for attr in ("transformer", "token_embedding", "ln_final",
+                     "positional_embedding", "text_projection"):
+            if getattr(model, attr, None) is not None:
+                setattr(model, attr, None)
+    elif keep == "text":
+        model.visual = None
+
 
-def load_model(name: str = "RN50", device: Union[str, torch.device] = "cpu"):
-    key = (name, str(device))
+def load_model(
+    name: str = "RN50",
+    device: Union[str, torch.device] = "cpu",
+    towers: str = "both",
+    quantize: bool = False,
+):
+    """
+    Build an OpenCLIP model with `openai` weights. `quantize` applies dynamic
+    int8 quantization to every nn.Linear (CPU only).
+    """
+    key = (name, str(device), towers, quantize)
     if key in _MODEL_CACHE:
         return _MODEL_CACHE[key]
 
+    if towers not in TOWERS:
+        raise ValueError(f"Invalid towers {towers!r}, must be one of {TOWERS}")
+
     # normalize device
     if isinstance(device, torch.device):
         torch_device = device
@@ -37,18 +107,34 @@ def load_model(name: str = "RN50", device: Union[str, torch.device] = "cpu"):
         except Exception:
             raise ValueError(f"Invalid device: {device!r}")
 
-    # Validate model name against available pretrained models
-    pretrained_list = open_clip.list_pretrained()
-    valid_models = {model_name for model_name, _ in pretrained_list}
-    if name not in valid_models:
-        raise ValueError(
-            f"Unknown model {name!r}, must be one of {sorted(valid_models)}"
-        )
+    model_embed_dim(name)                               # validates the name cheaply
 
-    model, _, preprocess = open_clip.create_model_and_transforms(
-        name, pretrained="openai", device=torch_device
-    )
-    model.to(torch_device).eval()
+    # build on CPU, drop the unused tower, then move only what is left
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(0)                            # PRETRAINED=none: same random init every time
+        model, _, preprocess = open_clip.create_model_and_transforms(
+            name, pretrained=None if PRETRAINED == "none" else PRETRAINED, device="cpu"
+        )
+    _drop_tower(model, towers)
+    model.eval()
+    if quantize:
+        if torch_device.type != "cpu":
+            raise ValueError("int8 dynamic quantization is CPU-only")
+        # plain Linear layers only, minus the ones OpenCLIP reads .weight/.bias
+        # from directly: ModifiedResNet's attnpool, and resblocks.0.mlp.c_fc
+        # (Transformer.get_cast_dtype). MHA's out_proj is not quantizable.
+        targets = {
+            n for n, m in model.named_modules()
+            if type(m) is torch.nn.Linear
+            and "attnpool" not in n and not n.endswith("resblocks.0.mlp.c_fc")
+        }
+        if towers != "text" and not any(n.startswith("visual.") for n in targets):
+            logging.warning(
+                "ENCODER_BACKEND=torch-int8 finds nothing to quantize in the %s image "
+                "tower – it runs as fp32; use onnx for a faster image encoder", name,
+            )
+        model = torch.ao.quantization.quantize_dynamic(model, targets, dtype=torch.qint8)
+    model.to(torch_device)
     _MODEL_CACHE[key] = (model, preprocess)
     return model, preprocess
 
@@ -61,13 +147,25 @@ class _Encoder:
 
     Attributes
     ----------
+    name : str
+        The OpenCLIP model name (keys cached embeddings).
     embed_dim : int
         The dimensionality of the embeddings produced by text() and image().
     device : torch.device
         The device on which model inference is performed.
+    towers : str
+        "both", "image" or "text" – which halves of CLIP are resident.
     """
 
-    def __init__(self, model: str = "RN50", device: Union[str, torch.device] = "cpu"):
+    backend = "torch"
+    quantize = False
+
+    def __init__(
+        self,
+        model: str = "RN50",
+        device: Union[str, torch.device] = "cpu",
+        towers: str = "both",
+    ):
         # normalize device and store
         if isinstance(device, torch.device):
             self.device = device
@@ -78,13 +176,28 @@ class _Encoder:
                 raise ValueError(f"Invalid device: {device!r}")
 
         # load model on correct device
-        self.model, self.preprocess = load_model(model, self.device)
+        self.name = model
+        self.towers = towers
+        self.model, self.preprocess = load_model(model, self.device, towers, self.quantize)
         self.tokenizer = open_clip.get_tokenizer(model)
+        self.embed_dim = model_embed_dim(model)
 
-        if hasattr(self.model, "visual"):
-            self.embed_dim = self.model.visual.output_dim
-        else:
-            self.embed_dim = self.model.text_projection.shape[-1]
+    def to(self, device: Union[str, torch.device]) -> "_Encoder":
+        """Move the weights and make later batches follow them."""
+        self.device = torch.device(device)
+        self.model.to(self.device)
+        return self
+
+    def _require(self, tower: str):
+        if self.towers not in ("both", tower):
+            raise RuntimeError(f"{tower} tower not loaded (ENCODER_TOWERS={self.towers})")
+
+    # forward hooks – the only part alternative backends replace
+    def _forward_text(self, tokens: torch.Tensor) -> torch.Tensor:
+        return self.model.encode_text(tokens.to(self.device))
+
+    def _forward_image(self, batch: torch.Tensor) -> torch.Tensor:
+        return self.model.encode_image(batch.to(self.device))
 
     @torch.no_grad()
     def text(
@@ -98,38 +211,270 @@ class _Encoder:
         List[float] or List[List[float]]
             Embedding(s) of dimension `self.embed_dim`, normalized to unit length.
         """
+        self._require("text")
         batched = isinstance(prompt, (list, tuple))
         prompts = prompt if batched else [prompt]
 
-        tokens = self.tokenizer(prompts).to(self.device)
-        feats = self.model.encode_text(tokens)
-        feats /= feats.norm(dim=-1, keepdim=True)
+        with stage("tokenize", len(prompts)):
+            tokens = self.tokenizer(prompts)
+        with stage("text_forward", len(prompts)):
+            feats = self._forward_text(tokens)
+            feats /= feats.norm(dim=-1, keepdim=True)
 
         feats_list = feats.cpu().tolist()
         return feats_list if batched else feats_list[0]
 
+    @staticmethod
+    def _to_pil(img) -> Image.Image:
+        if isinstance(img, (str, Path)):
+            return Image.open(img).convert("RGB")
+        if isinstance(img, bytes):
+            return Image.open(io.BytesIO(img)).convert("RGB")
+        if isinstance(img, Image.Image):
+            return img.convert("RGB")
+        raise TypeError("image() expects PIL.Image, path, or bytes")
+
     @torch.no_grad()
     def image(self, img) -> List[float]:
         """
         Accepts a PIL.Image, pathlib.Path, or raw bytes and returns a vector of length `self.embed_dim`.
         """
-        if isinstance(img, (str, Path)):
-            img = Image.open(img).convert("RGB")
-        elif isinstance(img, bytes):
-            img = Image.open(io.BytesIO(img)).convert("RGB")
-        elif isinstance(img, Image.Image):
-            img = img.convert("RGB")
-        else:
-            raise TypeError("image() expects PIL.Image, path, or bytes")
+        return self.images([img])[0]
+
+    @torch.no_grad()
+    def images(self, imgs: Iterable) -> List[List[float]]:
+        """
+        Batched variant of image(): preprocess every item, stack the tensors
+        and run a single forward pass. Returns one vector per input, in order.
+        """
+        return self.encode_tensors([self.preprocess_image(img) for img in imgs])
+
+    def preprocess_image(self, img) -> torch.Tensor:
+        """
+        Decode + preprocess one image into a CHW tensor, without touching the
+        model. Safe to call from worker threads feeding encode_tensors().
+        """
+        with stage("decode"):
+            pil = self._to_pil(img)
+        with stage("preprocess"):
+            return self.preprocess(pil)
+
+    @torch.no_grad()
+    def encode_tensors(self, tensors: List[torch.Tensor]) -> List[List[float]]:
+        """Forward pass over already-preprocessed tensors (see preprocess_image)."""
+        self._require("image")
+        if not tensors:
+            return []
+
+        with stage("image_forward", len(tensors)):
+            batch = torch.stack(tensors)
+            feats = self._forward_image(batch)
+            feats /= feats.norm(dim=-1, keepdim=True)
+        return feats.cpu().tolist()
+
 
-        tensor = self.preprocess(img).unsqueeze(0).to(self.device)
-        feat = self.model.encode_image(tensor)
-        feat /= feat.norm(dim=-1, keepdim=True)
-        return feat.squeeze(0).cpu().tolist()
+class _Int8Encoder(_Encoder):
+    """Same model with every nn.Linear dynamically quantized to int8 (CPU)."""
+
+    backend = "torch-int8"
+    quantize = True
+
+
+def export_onnx(model: str, tower: str) -> Path:
+    """
+    Path of the cached ONNX graph of one tower, exported on first use. Safe
+    to call from several processes at once: each exports into its own temp
+    dir under the final names (the exporter may put the weights in a side
+    `<name>.data` file that the graph refers to by name), then renames the
+    files into place – identical content, so the last rename wins harmlessly.
+    """
+    path = ONNX_CACHE_DIR / f"{model.replace('/', '_')}_{PRETRAINED}_{tower}.onnx"
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fp32, _ = load_model(model, "cpu", tower)
 
+    class _Tower(torch.nn.Module):
+        def __init__(self, fn):
+            super().__init__()
+            self.clip, self.fn = fp32, fn
 
-# ───────────────────────────────────────────────────────────── module-level singleton
-encoder = _Encoder(
+        def forward(self, x):
+            return getattr(self.clip, self.fn)(x)
+
+    # batch of 2: a batch of 1 gets specialised and loses the dynamic axis
+    if tower == "image":
+        size = open_clip.get_model_config(model)["vision_cfg"]["image_size"]
+        size = size if isinstance(size, int) else size[0]
+        example = torch.randn(2, 3, size, size)
+    else:
+        example = open_clip.get_tokenizer(model)(["a photo", "a picture"])
+    tmp = Path(tempfile.mkdtemp(prefix=f".{path.name}.", dir=path.parent))
+    try:
+        torch.onnx.export(
+            _Tower("encode_image" if tower == "image" else "encode_text"),
+            (example,), str(tmp / path.name),
+            input_names=["clip_input"], output_names=["clip_output"],
+            dynamic_axes={"clip_input": {0: "batch"}, "clip_output": {0: "batch"}},
+            opset_version=18,
+        )
+        # weights first, graph last: never leave a half-written model
+        for f in sorted(tmp.iterdir(), key=lambda f: f.name == path.name):
+            os.replace(f, path.parent / f.name)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    _MODEL_CACHE.pop((model, "cpu", tower, False), None)
+    return path
+
+
+class _OnnxEncoder(_Encoder):
+    """
+    Runs the CLIP towers with ONNX Runtime on CPU. Each tower is exported once
+    to ONNX_CACHE_DIR/<model>_<weights>_<tower>.onnx; later starts skip the PyTorch
+    weights entirely and only build the preprocess transform.
+    """
+
+    backend = "onnx"
+
+    def __init__(
+        self,
+        model: str = "RN50",
+        device: Union[str, torch.device] = "cpu",
+        towers: str = "both",
+    ):
+        import onnxruntime as ort                       # optional dependency
+
+        self.name      = model
+        self.towers    = towers
+        self.device    = torch.device("cpu")
+        self.model     = None
+        self.tokenizer = open_clip.get_tokenizer(model)
+        self.embed_dim = model_embed_dim(model)
+
+        size = open_clip.get_model_config(model)["vision_cfg"]["image_size"]
+        self._image_size = size if isinstance(size, int) else size[0]
+        self.preprocess  = open_clip.image_transform(self._image_size, is_train=False)
+
+        opts = ort.SessionOptions()
+        if INTRA_OP_THREADS:
+            opts.intra_op_num_threads = INTRA_OP_THREADS
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self._sessions = {}
+        for tower in ("image", "text"):
+            if towers in ("both", tower):
+                path = export_onnx(self.name, tower)
+                self._sessions[tower] = ort.InferenceSession(
+                    str(path), opts, providers=["CPUExecutionProvider"],
+                )
+
+    def to(self, device: Union[str, torch.device]) -> "_OnnxEncoder":
+        return self                                     # CPUExecutionProvider only
+
+    def _run(self, tower: str, x: torch.Tensor) -> torch.Tensor:
+        out = self._sessions[tower].run(None, {"clip_input": x.numpy()})[0]
+        return torch.from_numpy(out)
+
+    def _forward_text(self, tokens: torch.Tensor) -> torch.Tensor:
+        return self._run("text", tokens)
+
+    def _forward_image(self, batch: torch.Tensor) -> torch.Tensor:
+        return self._run("image", batch)
+
+
+def build_encoder(
+    model: str = "RN50",
+    device: Union[str, torch.device] = "cpu",
+    towers: str = "both",
+    backend: str = ENCODER_BACKEND,
+) -> _Encoder:
+    """Construct the encoder for `backend` ("torch", "torch-int8" or "onnx")."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Invalid encoder backend {backend!r}, must be one of {BACKENDS}")
+    if INTRA_OP_THREADS:
+        torch.set_num_threads(INTRA_OP_THREADS)
+    cls = {"torch": _Encoder, "torch-int8": _Int8Encoder, "onnx": _OnnxEncoder}[backend]
+    return cls(model, device, towers)
+
+
+def parity_check(
+    candidate: _Encoder,
+    reference: _Encoder | None = None,
+    images: List | None = None,
+    prompts: List[str] | None = None,
+) -> dict:
+    """
+    Cosine similarity between `candidate` and the fp32 PyTorch model on the
+    same inputs. 1.0 means identical embeddings; report min and mean per tower.
+    """
+    reference = reference or _Encoder(candidate.name, "cpu", candidate.towers)
+    if images is None:
+        gen = torch.Generator().manual_seed(0)
+        images = [
+            Image.fromarray((torch.rand(256, 256, 3, generator=gen) * 255).byte().numpy())
+            for _ in range(8)
+        ]
+    prompts = prompts or ["a red vintage car", "sunset over mountains", "a cat on a sofa"]
+
+    report: dict = {"backend": candidate.backend, "model": candidate.name}
+    pairs = []
+    if candidate.towers in ("both", "image"):
+        pairs.append(("image", candidate.images(images), reference.images(images)))
+    if candidate.towers in ("both", "text"):
+        pairs.append(("text", candidate.text(prompts), reference.text(prompts)))
+    for tower, got, want in pairs:
+        cos = (torch.tensor(got) * torch.tensor(want)).sum(dim=-1)   # both unit length
+        report[tower] = {"min_cos": round(cos.min().item(), 6), "mean_cos": round(cos.mean().item(), 6)}
+    return report
+
+
+# ───────────────────────────────────────────────────────────── lazy singleton
+class _LazyEncoder:
+    """
+    Stand-in for the module-level encoder. `name` and `embed_dim` are answered
+    without touching the weights; anything else builds the real _Encoder
+    (once, thread-safe) and forwards to it.
+    """
+
+    def __init__(self, model: str, device: str, towers: str):
+        self.name    = model
+        self._device = device
+        self._towers = towers
+        self._real: _Encoder | None = None
+        self._lock   = threading.Lock()
+
+    @property
+    def embed_dim(self) -> int:
+        return model_embed_dim(self.name)
+
+    @property
+    def loaded(self) -> bool:
+        return self._real is not None
+
+    def load(self) -> _Encoder:
+        if self._real is None:
+            with self._lock:
+                if self._real is None:
+                    self._real = build_encoder(self.name, self._device, self._towers)
+        return self._real
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+encoder = _LazyEncoder(
     model=os.getenv("MODEL", "RN50"),
-    device=os.getenv("DEVICE", "cpu")
+    device=os.getenv("DEVICE", "cpu"),
+    towers=os.getenv("ENCODER_TOWERS", "both"),
 )
+
+
+if __name__ == "__main__":
+    import argparse, json
+
+    ap = argparse.ArgumentParser(description="Encoder backend utilities")
+    ap.add_argument("--parity", action="store_true",
+                    help="report cosine drift of ENCODER_BACKEND against fp32 PyTorch")
+    args = ap.parse_args()
+    if args.parity:
+        print(json.dumps(parity_check(encoder.load()), indent=2))
@@ -0,0 +1,341 @@
+"""
+In-process vector store: normalized vectors in a memory-mapped file plus a
+JSON-lines sidecar, searched with exact (or IVF-pruned) dot products.
+
+Layout under VECTOR_DIR
+-----------------------
+meta.json     {"dims": 1024, "dtype": "float32", "model": "RN50"}
+vectors.bin   row-major (n, dims) array, appended by the embedder
+docs.jsonl    one {"_id": …, "path": …, <metadata>} line per row, same order
+
+Writers hold an flock on .write.lock while appending, so several embedder
+processes can share one store. Each appends vectors first and the sidecar
+line second, and readers
+only trust rows that have a complete sidecar line, so a reader in another
+process (search-api) never sees a half-written row.
+"""
+from __future__ import annotations
+
+import asyncio, fcntl, json, os, threading
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from common import filters
+from common.backends import VectorBackend
+from common.models import encoder
+
+# ────────────────────────────────────────────────────────────────────────────────
+# CONFIG
+VECTOR_DIR    = Path(os.getenv("VECTOR_DIR", "/data/vectors"))
+VECTOR_DTYPE  = os.getenv("VECTOR_DTYPE", "float32")          # or float16
+IVF_MIN_ROWS  = int(os.getenv("NUMPY_IVF_MIN_ROWS", 0))        # 0 = always exact
+IVF_NLIST     = int(os.getenv("NUMPY_IVF_NLIST", 0))           # 0 = ≈ sqrt(rows)
+IVF_NPROBE    = int(os.getenv("NUMPY_IVF_NPROBE", 8))
+BLOCK_ROWS    = 65536                                          # rows scored per matmul
+
+
+def _normalize(mat: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(mat, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return mat / norms
+
+
+def _cos_to_score(cos: np.ndarray) -> np.ndarray:
+    # same scale Elasticsearch uses for `similarity: cosine`
+    return (1 + cos) / 2
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# IVF
+class _IVF:
+    """
+    Inverted-file index: spherical k-means centroids, one row list per
+    centroid. A query scores only the rows of its `nprobe` nearest lists.
+    """
+
+    def __init__(self, nlist: int, nprobe: int):
+        self.nlist   = nlist
+        self.nprobe  = nprobe
+        self.built_n = 0
+        self.centroids: np.ndarray | None = None
+        self.lists: list[np.ndarray] = []
+
+    def build(self, mat: np.ndarray, iters: int = 10, sample: int = 50_000):
+        n   = mat.shape[0]
+        rng = np.random.default_rng(0)
+        nlist = self.nlist or max(1, int(np.sqrt(n)))
+        pts = np.asarray(mat[np.sort(rng.choice(n, min(n, sample), replace=False))], np.float32)
+        cent = pts[rng.choice(len(pts), min(nlist, len(pts)), replace=False)].copy()
+        for _ in range(iters):
+            assign = np.argmax(pts @ cent.T, axis=1)
+            for c in range(len(cent)):
+                members = pts[assign == c]
+                if len(members):
+                    cent[c] = members.mean(axis=0)
+            cent = _normalize(cent)
+        self.centroids = cent
+        self.lists = [np.empty(0, np.int64) for _ in range(len(cent))]
+        self.built_n = 0
+        self.add(mat, 0, n)
+        self.built_n = n
+
+    def add(self, mat: np.ndarray, start: int, end: int):
+        for lo in range(start, end, BLOCK_ROWS):
+            hi = min(lo + BLOCK_ROWS, end)
+            assign = np.argmax(np.asarray(mat[lo:hi], np.float32) @ self.centroids.T, axis=1)
+            for c in np.unique(assign):
+                rows = np.nonzero(assign == c)[0] + lo
+                self.lists[c] = np.concatenate([self.lists[c], rows])
+
+    def candidates(self, q: np.ndarray) -> np.ndarray:
+        nprobe = min(self.nprobe, len(self.centroids))
+        best = np.argpartition(-(self.centroids @ q), nprobe - 1)[:nprobe]
+        return np.sort(np.concatenate([self.lists[c] for c in best]))
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# BACKEND
+class NumpyBackend(VectorBackend):
+    """
+    Exact top-k by blocked matmul + argpartition over a memory-mapped matrix.
+    With NUMPY_IVF_MIN_ROWS set, corpora at least that large are searched
+    through an IVF index instead (rebuilt once the corpus grows by 20 %).
+    """
+
+    name = "numpy"
+
+    def __init__(self, root: Path = VECTOR_DIR, dtype: str = VECTOR_DTYPE):
+        self.root      = Path(root)
+        self.dtype     = np.dtype(dtype)
+        self.meta_path = self.root / "meta.json"
+        self.vec_path  = self.root / "vectors.bin"
+        self.doc_path  = self.root / "docs.jsonl"
+        self.dim       = 0
+        self._lock     = threading.Lock()
+        self._docs: list[dict] = []
+        self._ids: dict[str, int] = {}
+        self._offset   = 0                  # bytes of docs.jsonl consumed
+        self._mat: np.ndarray | None = None
+        self._ivf: _IVF | None = None
+        self._mtime    = 0.0
+
+    # — layout —
+    def ensure_index(self):
+        dim  = encoder.embed_dim
+        want = {"dims": dim, "dtype": self.dtype.name, "model": encoder.name}
+        self.root.mkdir(parents=True, exist_ok=True)
+        have = json.loads(self.meta_path.read_text()) if self.meta_path.exists() else None
+        if have is not None and "model" not in have and have | {"model": encoder.name} == want:
+            # stores from before the model was recorded: adopt them
+            self.meta_path.write_text(json.dumps(want))
+        elif have != want:
+            # new store, or the model / dtype changed: start over
+            for p in (self.vec_path, self.doc_path):
+                p.unlink(missing_ok=True)
+            self.meta_path.write_text(json.dumps(want))
+        self.dim = dim
+        with self._lock:
+            self._reset()
+            self._refresh()
+
+    def target(self) -> str:
+        # meta.json is rewritten whenever the store is wiped
+        return f"numpy:{self.root}:{self.meta_path.stat().st_mtime_ns}"
+
+    def _reset(self):
+        self._docs, self._ids, self._offset = [], {}, 0
+        self._mat, self._ivf = None, None
+
+    def _refresh(self):
+        """Pick up rows appended since the last call (by us or another process)."""
+        try:
+            st = self.doc_path.stat()
+        except FileNotFoundError:
+            return
+        if st.st_size < self._offset:         # store was wiped underneath us
+            self._reset()
+        if st.st_size == self._offset:
+            return
+
+        with self.doc_path.open("rb") as f:
+            f.seek(self._offset)
+            chunk = f.read()
+        complete = chunk[:chunk.rfind(b"\n") + 1]  # ignore a half-written last line
+        self._offset += len(complete)
+        for line in complete.splitlines():
+            doc = json.loads(line)
+            self._ids[doc["_id"]] = len(self._docs)
+            self._docs.append(doc)
+        self._mtime = st.st_mtime
+
+        n = len(self._docs)
+        old_n = 0 if self._mat is None else self._mat.shape[0]
+        self._mat = np.memmap(self.vec_path, dtype=self.dtype, mode="r", shape=(n, self.dim))
+
+        if IVF_MIN_ROWS and n >= IVF_MIN_ROWS:
+            if self._ivf is None or n > 1.2 * self._ivf.built_n:
+                self._ivf = _IVF(IVF_NLIST, IVF_NPROBE)
+                self._ivf.build(self._mat)
+            else:
+                self._ivf.add(self._mat, old_n, n)
+
+    # — write side —
+    def existing_ids(self, ids: list[str]) -> set[str]:
+        with self._lock:
+            self._refresh()
+            return {i for i in ids if i in self._ids}
+
+    def bulk_index(self, docs: Iterable[tuple[str, dict]], chunk_size: int = 500) -> list[str]:
+        docs = list(docs)
+        # the thread lock guards our state; the file lock serialises writers
+        # across processes (sharded embedders append to the same files)
+        with self._lock, (self.root / ".write.lock").open("w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._refresh()
+            fresh: dict[str, dict] = {}
+            for doc_id, doc in docs:
+                if doc_id not in self._ids:
+                    fresh.setdefault(doc_id, doc)
+            if fresh:
+                vecs = _normalize(np.asarray([d["vector"] for d in fresh.values()], np.float32))
+                with self.vec_path.open("ab") as f:
+                    # drop rows orphaned by a crash between the two appends
+                    f.truncate(len(self._docs) * self.dim * self.dtype.itemsize)
+                    f.write(vecs.astype(self.dtype).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                with self.doc_path.open("ab") as f:
+                    for doc_id, doc in fresh.items():
+                        side = {k: v for k, v in doc.items() if k != "vector"}
+                        f.write(json.dumps({"_id": doc_id, **side}).encode() + b"\n")
+                self._refresh()
+        # ids that were already present count as indexed, as with ES
+        return [doc_id for doc_id, _ in docs]
+
+    # — read side —
+    def _hits(self, rows: np.ndarray, scores: np.ndarray, fields: list[str]) -> list[dict]:
+        out = []
+        for row, score in zip(rows, scores):
+            doc = self._docs[row]
+            out.append({
+                **{f: doc[f] for f in fields if f in doc},
+                "id": doc["_id"], "score": float(score),
+            })
+        return out
+
+    def _exact(self, q: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Blocked (n × dims) @ (dims × queries) with a running top-k per query."""
+        n, nq = self._mat.shape[0], q.shape[0]
+        best_s = np.full((nq, 0), -np.inf, np.float32)
+        best_i = np.empty((nq, 0), np.int64)
+        for lo in range(0, n, BLOCK_ROWS):
+            block = np.asarray(self._mat[lo:lo + BLOCK_ROWS], np.float32)
+            s = np.concatenate([best_s, q @ block.T], axis=1)
+            i = np.concatenate([best_i, np.broadcast_to(np.arange(lo, lo + len(block)), (nq, len(block)))], axis=1)
+            if s.shape[1] > k:
+                keep = np.argpartition(-s, k - 1, axis=1)[:, :k]
+                s, i = np.take_along_axis(s, keep, 1), np.take_along_axis(i, keep, 1)
+            best_s, best_i = s, i
+        order = np.argsort(-best_s, axis=1)
+        return np.take_along_axis(best_i, order, 1), np.take_along_axis(best_s, order, 1)
+
+    def _ivf_one(self, q: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        rows = self._ivf.candidates(q)
+        s = np.asarray(self._mat[rows], np.float32) @ q
+        if len(s) > k:
+            keep = np.argpartition(-s, k - 1)[:k]
+            rows, s = rows[keep], s[keep]
+        order = np.argsort(-s)
+        return rows[order], s[order]
+
+    def _subset(self, q: np.ndarray, rows: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Exact top-k of one query over the given rows only (filtered search)."""
+        best_s = np.empty(0, np.float32)
+        best_i = np.empty(0, np.int64)
+        for lo in range(0, len(rows), BLOCK_ROWS):
+            part = rows[lo:lo + BLOCK_ROWS]
+            s = np.concatenate([best_s, np.asarray(self._mat[part], np.float32) @ q])
+            i = np.concatenate([best_i, part])
+            if len(s) > k:
+                keep = np.argpartition(-s, k - 1)[:k]
+                s, i = s[keep], i[keep]
+            best_s, best_i = s, i
+        order = np.argsort(-best_s)
+        return best_i[order], best_s[order]
+
+    def _matching(self, spec: dict, cache: dict) -> np.ndarray:
+        key = filters.key(spec)
+        if key not in cache:
+            cache[key] = np.fromiter(
+                (r for r, doc in enumerate(self._docs) if filters.matches(doc, spec)), np.int64,
+            )
+        return cache[key]
+
+    def knn_msearch(self, queries, source_fields=None):
+        fields = source_fields or ["path"]
+        with self._lock:
+            self._refresh()
+            if self._mat is None or not len(self._docs) or not queries:
+                return [[] for _ in queries]
+            q = _normalize(np.asarray([query[0] for query in queries], np.float32))
+            specs = [query[3] if len(query) > 3 else None for query in queries]
+            results: list = [None] * len(queries)
+
+            # filtered queries: exact scan of the matching rows
+            subsets: dict = {}
+            for j, spec in enumerate(specs):
+                if spec:
+                    results[j] = self._subset(q[j], self._matching(spec, subsets), queries[j][1])
+
+            plain = [j for j, spec in enumerate(specs) if not spec]
+            if plain:
+                kmax = max(queries[j][1] for j in plain)
+                if self._ivf is not None:
+                    for j in plain:
+                        results[j] = self._ivf_one(q[j], kmax)
+                else:
+                    rows, cos = self._exact(q[plain], kmax)
+                    for j, r, c in zip(plain, rows, cos):
+                        results[j] = (r, c)
+            return [
+                self._hits(r[:query[1]], _cos_to_score(s[:query[1]]), fields)
+                for (r, s), query in zip(results, queries)
+            ]
+
+    def get_vectors(self, ids):
+        with self._lock:
+            self._refresh()
+            rows = {i: self._ids[i] for i in ids if i in self._ids}
+            return {i: np.asarray(self._mat[r], np.float32).tolist() for i, r in rows.items()}
+
+    # knn_msearch_async / get_vectors_async: the base class runs them in a
+    # thread, as big scans hold self._lock (and release the GIL inside BLAS)
+    def _generation(self) -> tuple:
+        with self._lock:
+            self._refresh()
+            return (len(self._docs), self._mtime)
+
+    async def generation_async(self) -> tuple:
+        # _refresh() may wait for a scan or rebuild the IVF index: not on the loop
+        return await asyncio.to_thread(self._generation)
+
+    def _info(self) -> dict:
+        with self._lock:
+            self._refresh()
+            n = len(self._docs)
+        ivf = self._ivf
+        return {
+            "backend":   self.name,
+            "version":   f"numpy {np.__version__}",
+            "doc_count": n,
+            "status":    "ivf" if ivf is not None else "exact",
+            "index_options": (
+                {"type": "ivf", "nlist": len(ivf.centroids), "nprobe": ivf.nprobe}
+                if ivf is not None else {"type": "exact"}
+            ) | {"dtype": self.dtype.name},
+        }
+
+    async def info_async(self) -> dict:
+        return await asyncio.to_thread(self._info)
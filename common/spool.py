@@ -0,0 +1,56 @@
+"""
+Hand-off channel between the downloader and the embedder.
+
+After an image is completely written, the downloader drops an empty
+`<name>.ready` marker into SPOOL_DIR (a hidden directory on the shared images
+volume). The embedder lists that directory every second or so – cheap even
+when idle – embeds just the announced files and removes their markers.
+Plain files work across containers and restarts: markers written while the
+embedder is down are simply picked up when it comes back.
+
+Stdlib only, so the downloader can import it without the model stack.
+"""
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+SPOOL_DIR = Path(os.getenv("SPOOL_DIR", "/data/images/.spool"))
+_SUFFIX   = ".ready"                    # keeps markers out of the *.jpg / *.png walk
+
+
+def _marker(spool_dir: Path, name: str) -> Path:
+    return spool_dir / (name.replace("/", "%2F") + _SUFFIX)
+
+
+def notify(name: str, spool_dir: Path = SPOOL_DIR):
+    """Announce that `name` (relative to the images dir) is ready to embed."""
+    spool_dir.mkdir(parents=True, exist_ok=True)
+    _marker(spool_dir, name).touch()
+
+
+def pending(spool_dir: Path = SPOOL_DIR, limit: int | None = None) -> list[str]:
+    """Names announced so far, oldest first (at most `limit`)."""
+    try:
+        entries = [e for e in os.scandir(spool_dir) if e.name.endswith(_SUFFIX)]
+    except FileNotFoundError:
+        return []
+    # DirEntry.stat() is a syscall on Linux: a marker another shard acks in
+    # between is gone by then, so just drop it
+    stamped: list[tuple[int, str]] = []
+    for e in entries:
+        try:
+            stamped.append((e.stat().st_mtime_ns, e.name))
+        except FileNotFoundError:
+            continue
+    stamped.sort()
+    return [name[:-len(_SUFFIX)].replace("%2F", "/") for _, name in stamped[:limit]]
+
+
+def ack(names: list[str], spool_dir: Path = SPOOL_DIR):
+    """Drop the markers for `names` once they have been handled."""
+    for name in names:
+        try:
+            _marker(spool_dir, name).unlink()
+        except FileNotFoundError:
+            pass
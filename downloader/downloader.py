@@ -1,74 +1,171 @@
 """
 Downloader ‑ poll mode
-Re‑reads URL_FILE every POLL_SECONDS, fetches any images that do not
-yet exist in OUTPUT_DIR, then sleeps.
+Every POLL_SECONDS, picks up URLs appended to URL_FILE and fetches whatever
+the URL-state store (state.py) says is due: new URLs, failed ones whose
+jittered backoff expired and, with REVALIDATE_SECONDS > 0, old downloads
+via conditional requests (ETag / Last-Modified). Bodies are streamed to a
+temp file, checked by the ingest stage (ingest.py: content dedup, decode
+validation, downscaled derivative) and renamed into OUTPUT_DIR, so the
+embedder never sees a partial image; every new file is announced through the spool directory
+(common/spool.py), so it is embedded right away.
 """
 
 import asyncio, aiohttp, aiofiles, hashlib, os, sys, time
 from pathlib import Path
+from urllib.parse import urlsplit
+
+from common import spool, metrics
+from state import UrlState, Job
+import ingest
 
 # ── tunables ────────────────────────────────────────────────────────────
 DATASET_PATH  = os.getenv("URL_FILE",      "/urls.txt")
 OUT_DIR       = Path(os.getenv("OUTPUT_DIR", "/data/images"))
+STATE_PATH    = Path(os.getenv("DOWNLOAD_STATE_PATH", "/data/state/downloader.sqlite"))
 CONCURRENCY   = int(os.getenv("MAX_CONCURRENCY", 32))
+PER_HOST      = int(os.getenv("PER_HOST_CONCURRENCY", 4))      # open connections per host
 POLL_SECONDS  = int(os.getenv("POLL_SECONDS", 30))
-TIMEOUT       = aiohttp.ClientTimeout(total=30)
+RETRY_BASE    = float(os.getenv("DOWNLOAD_RETRY_BASE_SECONDS", 60))
+RETRY_MAX     = float(os.getenv("DOWNLOAD_RETRY_MAX_SECONDS", 86400))
+REVALIDATE    = float(os.getenv("REVALIDATE_SECONDS", 0))     # 0 = never re-check downloads
+MAX_BYTES     = int(float(os.getenv("MAX_DOWNLOAD_MB", 50)) * 2**20)
+CHUNK_BYTES   = 64 * 1024
+PAGE_SIZE     = CONCURRENCY * 8                               # due URLs loaded per batch
+TIMEOUT       = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
 # ────────────────────────────────────────────────────────────────────────
 
+# ── metrics (sidecar on METRICS_PORT) ──────────────────────────────────
+FETCH_S = metrics.Histogram(
+    "downloader_fetch_seconds", "Request + streaming time per URL", ["host"], buckets=metrics.BUCKETS,
+)
+BYTES   = metrics.Counter("downloader_bytes_total", "Body bytes received", ["host"])
+ERRORS  = metrics.Counter("downloader_errors_total", "Failed fetches", ["host", "kind"])
+RESULTS = metrics.Counter("downloader_results_total", "Fetch outcomes", ["result"])
+
 def fname_from_url(url: str) -> str:
     return hashlib.sha1(url.encode()).hexdigest()[:16] + ".jpg"
 
-async def fetch(session, url):
+def error_kind(exc: Exception) -> str:
+    status = getattr(exc, "status", None)
+    return str(status) if status else type(exc).__name__
+
+def retry_after(exc: Exception) -> float | None:
+    """Honour a numeric Retry-After on 429 / 503 answers."""
+    headers = getattr(exc, "headers", None) or {}
     try:
-        async with session.get(url) as resp:
-            resp.raise_for_status()
-            return await resp.read(), None
-    except Exception as e:
-        return None, e
+        return float(headers.get("Retry-After", ""))
+    except ValueError:
+        return None
 
-async def download_round():
-    """Return number of newly downloaded files in this cycle."""
-    urls = [u.strip() for u in open(DATASET_PATH) if u.strip()]
-    queue = asyncio.Queue()
-    for u in urls:
-        if not (OUT_DIR / fname_from_url(u)).exists():
-            queue.put_nowait(u)
+async def fetch(session, job: Job) -> tuple[str | None, bool, str | None, str | None]:
+    """
+    Stream `job.url` through the ingest stage into OUT_DIR. Returns
+    (file name, created, etag, last_modified); the name is None when the
+    stored file is still current (304 Not Modified) and created is False
+    when the content was already on disk under that name.
+    """
+    out_file = OUT_DIR / (job.fname or fname_from_url(job.url))
+    host     = urlsplit(job.url).hostname or "-"
+    headers  = {}
+    if out_file.exists():
+        if not (job.etag or job.last_modified):
+            return None, False, None, None   # fetched before the state store existed
+        if job.etag:
+            headers["If-None-Match"] = job.etag
+        if job.last_modified:
+            headers["If-Modified-Since"] = job.last_modified
 
-    if queue.empty():
-        return 0  # nothing new to do
+    async with session.get(job.url, headers=headers) as resp:
+        if resp.status == 304:
+            return None, False, None, None
+        resp.raise_for_status()
+        url_name = fname_from_url(job.url)
+        tmp = OUT_DIR / f".{url_name}.part"                  # hidden, never globbed
+        try:
+            size, h = 0, hashlib.sha256()
+            async with aiofiles.open(tmp, "wb") as f:
+                async for chunk in resp.content.iter_chunked(CHUNK_BYTES):
+                    size += len(chunk)
+                    BYTES.labels(host).inc(len(chunk))
+                    if size > MAX_BYTES:
+                        raise ValueError(f"larger than {MAX_BYTES} bytes")
+                    h.update(chunk)
+                    await f.write(chunk)
+            # validate / dedup / derivative, then an atomic rename into place
+            with metrics.stage("ingest"):
+                name, created = await asyncio.to_thread(
+                    ingest.finalize, tmp, OUT_DIR, h.hexdigest(), url_name, job.url,
+                )
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        return name, created, resp.headers.get("ETag"), resp.headers.get("Last-Modified")
 
-    conn = aiohttp.TCPConnector(limit=CONCURRENCY)
-    async with aiohttp.ClientSession(timeout=TIMEOUT, connector=conn) as s:
+async def download_round(session, state: UrlState) -> tuple[int, int]:
+    """Fetch every due URL, a page at a time. Return (downloaded, failed)."""
+    done, failed = 0, 0
 
-        async def worker(name):
-            while True:
-                url = await queue.get()
-                data, err = await fetch(s, url)
-                if err:
-                    print(f"[{name}] ❌ {url} – {err}")
-                else:
-                    out_file = OUT_DIR / fname_from_url(url)
-                    async with aiofiles.open(out_file, "wb") as f:
-                        await f.write(data)
-                    print(f"[{name}] ✅ {url}")
+    async def worker(name, queue):
+        nonlocal done, failed
+        while True:
+            job  = await queue.get()
+            host = urlsplit(job.url).hostname or "-"
+            try:
+                with FETCH_S.labels(host).time():
+                    fname, created, etag, last_modified = await fetch(session, job)
+            except Exception as e:
+                failed += 1
+                ERRORS.labels(host, error_kind(e)).inc()
+                RESULTS.labels("failed").inc()
+                # a body that is not an image will not turn into one soon
+                wait = RETRY_MAX if isinstance(e, ingest.InvalidImage) else retry_after(e)
+                delay = state.mark_failed(job.url, wait)
+                print(f"[{name}] ❌ {job.url} – {e} (retry in {delay:.0f}s)")
+            else:
+                state.mark_done(job.url, fname, etag, last_modified)
+                RESULTS.labels("new" if created else "duplicate" if fname else "unchanged").inc()
+                if created:
+                    spool.notify(fname)                # embedder picks it up now
+                    done += 1
+                    print(f"[{name}] ✅ {job.url}")
+                elif fname:
+                    print(f"[{name}] = {job.url} – same content as {fname}")
+            finally:
                 queue.task_done()
 
-        tasks = [asyncio.create_task(worker(f"W{i}"))
-                 for i in range(CONCURRENCY)]
-
+    while jobs := state.due(PAGE_SIZE, REVALIDATE):
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        tasks = [asyncio.create_task(worker(f"W{i}", queue))
+                 for i in range(min(CONCURRENCY, len(jobs)))]
         await queue.join()
         for t in tasks:
             t.cancel()
 
-    return queue.qsize()  # how many we processed
+    return done, failed
 
 async def run_forever():
     OUT_DIR.mkdir(parents=True, exist_ok=True)
-    while True:
-        new_count = await download_round()
-        if new_count:
-            print(f"✓ download round complete – {new_count} new file(s)")
-        await asyncio.sleep(POLL_SECONDS)
+    metrics.serve()
+    state = UrlState(STATE_PATH, retry_base=RETRY_BASE, retry_max=RETRY_MAX)
+    # connections are capped overall and per host, so one slow domain
+    # cannot take every slot
+    conn = aiohttp.TCPConnector(limit=CONCURRENCY, limit_per_host=PER_HOST)
+    async with aiohttp.ClientSession(timeout=TIMEOUT, connector=conn) as session:
+        while True:
+            try:
+                added = state.sync_url_file(DATASET_PATH)
+            except FileNotFoundError:
+                added = 0
+            if added:
+                print(f"+ {added} new URL(s) in {DATASET_PATH}")
+            t0 = time.perf_counter()
+            new_count, failed = await download_round(session, state)
+            if new_count or failed:
+                print(f"✓ download round complete – {new_count} new file(s), "
+                      f"{failed} failure(s) in {time.perf_counter() - t0:.1f}s")
+            await asyncio.sleep(POLL_SECONDS)
 
 if __name__ == "__main__":
     try:
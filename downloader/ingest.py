@@ -0,0 +1,109 @@
+"""
+Optional ingest stage between "bytes on disk" and "file in OUTPUT_DIR".
+
+* dedup      – name files by content hash, so one image reached through
+               several URLs is stored (and embedded) once
+* validate   – reject bodies Pillow cannot decode (HTML error pages, …)
+* derivative – also write a small JPEG whose shortest side is DERIVATIVE_SIZE
+               to DERIVED_DIR under the same name; the embedder preprocesses
+               that instead of the multi-megapixel original. JPEGs are decoded
+               in draft mode (DCT scaling), so this costs a fraction of a
+               full decode.
+* metadata   – record the source URL of each stored file in META_DIR as
+               <name>.json; the embedder indexes it for search filters
+
+finalize() is blocking (Pillow); the downloader runs it in a thread.
+"""
+
+from __future__ import annotations
+
+import json, os, threading
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from PIL import Image
+
+INGEST_DEDUP    = os.getenv("INGEST_DEDUP", "1") == "1"
+INGEST_VALIDATE = os.getenv("INGEST_VALIDATE", "1") == "1"
+DERIVATIVE_SIZE = int(os.getenv("DERIVATIVE_SIZE", 0))            # 0 = no derivative
+DERIVED_DIR     = Path(os.getenv("DERIVED_DIR", "/data/images/.derived"))
+META_DIR        = Path(os.getenv("META_DIR", "/data/images/.meta"))
+DERIVATIVE_QUALITY = 90
+
+_claim = threading.Lock()              # two URLs, same bytes, finishing together
+
+
+class InvalidImage(ValueError):
+    """The downloaded bytes are not an image Pillow can decode."""
+
+
+def _open(path: Path, size: int) -> tuple[Image.Image, str]:
+    try:
+        img = Image.open(path)
+        fmt = img.format or ""
+        if size:
+            img.draft("RGB", (size, size))                # JPEG: decode at ≥ size
+        img.load()
+    except Exception as exc:
+        raise InvalidImage(f"not a decodable image: {exc}") from exc
+    return img, fmt
+
+
+def _part(out: Path) -> Path:
+    # one temp file per writer: two URLs with the same bytes finalize at once
+    return out.with_name(f".{out.name}.{os.getpid()}.{threading.get_ident()}.part")
+
+
+def _write_derivative(img: Image.Image, out: Path, size: int):
+    img = img.convert("RGB")
+    scale = size / min(img.size)
+    if scale < 1:
+        img = img.resize(
+            (max(round(img.width * scale), 1), max(round(img.height * scale), 1)),
+            Image.BICUBIC,
+        )
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _part(out)
+    try:
+        img.save(tmp, "JPEG", quality=DERIVATIVE_QUALITY)
+        os.replace(tmp, out)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def _write_meta(out: Path, url: str):
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _part(out)
+    try:
+        tmp.write_text(json.dumps({"url": url, "domain": urlsplit(url).hostname or ""}))
+        os.replace(tmp, out)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def finalize(tmp: Path, out_dir: Path, digest: str, url_name: str, url: str) -> tuple[str, bool]:
+    """
+    Validate `tmp` and move it into `out_dir`. Returns (file name, created);
+    created is False when identical content is already stored (dedup hit),
+    in which case `tmp` is simply dropped and the first URL stays on record.
+    """
+    img, fmt = _open(tmp, DERIVATIVE_SIZE) if (INGEST_VALIDATE or DERIVATIVE_SIZE) else (None, "")
+    if INGEST_DEDUP:
+        name = digest[:16] + (".png" if fmt == "PNG" else ".jpg")
+        if (out_dir / name).exists():
+            tmp.unlink(missing_ok=True)
+            return name, False
+    else:
+        name = url_name
+
+    # derivative and metadata land first: once the original appears, the
+    # embedder can rely on them being there
+    if DERIVATIVE_SIZE:
+        _write_derivative(img, DERIVED_DIR / name, DERIVATIVE_SIZE)
+    _write_meta(META_DIR / f"{name}.json", url)
+    with _claim:
+        if INGEST_DEDUP and (out_dir / name).exists():
+            tmp.unlink(missing_ok=True)
+            return name, False
+        os.replace(tmp, out_dir / name)
+    return name, True
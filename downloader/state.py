@@ -0,0 +1,157 @@
+"""
+Persistent per-URL state for the downloader.
+
+One row per URL with its status, the validators the server sent (ETag /
+Last-Modified) and the failure count with the time of the next attempt.
+New URLs are read from URL_FILE incrementally – an append-only list is
+consumed from the last byte offset instead of being re-read every round –
+and only rows that are due are ever handed to the fetch workers.
+"""
+
+from __future__ import annotations
+
+import random, sqlite3, time
+from pathlib import Path
+from typing import NamedTuple
+
+NEW    = "new"
+DONE   = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    url            TEXT PRIMARY KEY,
+    status         TEXT NOT NULL,
+    fname          TEXT,                -- file in OUTPUT_DIR (content-addressed with dedup)
+    etag           TEXT,
+    last_modified  TEXT,
+    failures       INTEGER NOT NULL DEFAULT 0,
+    next_retry     REAL NOT NULL DEFAULT 0,
+    checked_at     REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS urls_due ON urls (status, next_retry);
+CREATE TABLE IF NOT EXISTS meta (
+    key    TEXT PRIMARY KEY,
+    value  TEXT NOT NULL
+)
+"""
+
+
+class Job(NamedTuple):
+    url: str
+    fname: str | None
+    etag: str | None
+    last_modified: str | None
+
+
+class UrlState:
+    """sqlite wrapper; use it from the event-loop thread only."""
+
+    def __init__(self, path: Path, retry_base: float = 60, retry_max: float = 86400):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        cols = {r[1] for r in self.conn.execute("PRAGMA table_info(urls)")}
+        if "fname" not in cols:                             # state from before ingest
+            self.conn.execute("ALTER TABLE urls ADD COLUMN fname TEXT")
+        self.conn.commit()
+        self.retry_base = retry_base
+        self.retry_max  = retry_max
+
+    def _meta(self, key: str) -> str | None:
+        row = self.conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def sync_url_file(self, path: str, chunk: int = 10_000) -> int:
+        """
+        Add URLs from `path` that are not known yet; return how many.
+        Only the bytes appended since the last call are read unless the file
+        was replaced or truncated, in which case it is read from the start.
+        """
+        p = Path(path)
+        st = p.stat()
+        ident  = f"{st.st_dev}:{st.st_ino}"
+        offset = int(self._meta("url_file_offset") or 0)
+        if self._meta("url_file_ident") != ident or st.st_size < offset:
+            offset = 0
+        if st.st_size == offset:
+            return 0
+
+        added = 0
+        with p.open("rb") as f:
+            f.seek(offset)
+            while True:
+                lines = f.readlines(chunk * 64)
+                if not lines:
+                    break
+                if not lines[-1].endswith(b"\n"):       # half-written last line
+                    f.seek(-len(lines[-1]), 1)
+                    lines.pop()
+                    if not lines:
+                        break
+                urls = [(u,) for u in (l.decode().strip() for l in lines) if u]
+                with self.conn:
+                    before = self.conn.total_changes
+                    self.conn.executemany(
+                        f"INSERT OR IGNORE INTO urls (url, status) VALUES (?, '{NEW}')", urls,
+                    )
+                    added += self.conn.total_changes - before
+            offset = f.tell()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [("url_file_ident", ident), ("url_file_offset", str(offset))],
+            )
+        return added
+
+    def due(self, limit: int, revalidate_after: float = 0) -> list[Job]:
+        """
+        URLs to fetch now: new ones, failed ones whose backoff expired and –
+        when `revalidate_after` > 0 – downloaded ones not checked for that long.
+        """
+        now = time.time()
+        rows = self.conn.execute(
+            f"""
+            SELECT url, fname, etag, last_modified FROM urls
+            WHERE status='{NEW}'
+               OR (status='{FAILED}' AND next_retry <= ?)
+               OR (? > 0 AND status='{DONE}' AND checked_at <= ?)
+            LIMIT ?
+            """,
+            (now, revalidate_after, now - revalidate_after, limit),
+        )
+        return [Job(*r) for r in rows]
+
+    def mark_done(
+        self, url: str, fname: str | None = None,
+        etag: str | None = None, last_modified: str | None = None,
+    ):
+        """Record a 200 (new file / validators) or 304 (unchanged, pass None)."""
+        with self.conn:
+            self.conn.execute(
+                """
+                UPDATE urls SET status=?, failures=0, next_retry=0, checked_at=?,
+                       fname=COALESCE(?, fname),
+                       etag=COALESCE(?, etag), last_modified=COALESCE(?, last_modified)
+                WHERE url=?
+                """,
+                (DONE, time.time(), fname, etag, last_modified, url),
+            )
+
+    def mark_failed(self, url: str, retry_after: float | None = None) -> float:
+        """Jittered exponential backoff; returns the delay in seconds."""
+        row = self.conn.execute("SELECT failures FROM urls WHERE url=?", (url,)).fetchone()
+        failures = (row[0] if row else 0) + 1
+        delay = min(self.retry_base * 2 ** (failures - 1), self.retry_max)
+        delay = max(delay * random.uniform(0.5, 1.5), retry_after or 0)
+        with self.conn:
+            self.conn.execute(
+                "UPDATE urls SET status=?, failures=?, next_retry=?, checked_at=? WHERE url=?",
+                (FAILED, failures, time.time() + delay, time.time(), url),
+            )
+        return delay
+
+    def counts(self) -> dict[str, int]:
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM urls GROUP BY status"))
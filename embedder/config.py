@@ -6,12 +6,47 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import Field
 from pathlib import Path
 from common.models import encoder
+from common import spool
 
 class Settings(BaseSettings):
     images_dir: Path = Field("/data/images", env="IMAGES_DIR")
     es_host: str = Field("http://es:9200", env="ES_HOST")
     batch_size: int = Field(32, env="BATCH_SIZE")
+    check_chunk_size: int = Field(2000, env="CHECK_CHUNK_SIZE")      # ids per _mget
+    bulk_chunk_size: int = Field(500, env="BULK_CHUNK_SIZE")         # docs per _bulk
+    backfill_threshold: int = Field(1000, env="BACKFILL_THRESHOLD")  # pause refresh above this
+    decode_workers: int = Field(4, env="DECODE_WORKERS")              # decode/preprocess threads
+    decode_queue_depth: int = Field(128, env="DECODE_QUEUE_DEPTH")    # tensors waiting for the model
+    write_queue_depth: int = Field(8, env="WRITE_QUEUE_DEPTH")        # batches waiting for ES
+    manifest_path: Path = Field("/data/state/manifest.sqlite", env="MANIFEST_PATH")
+    embedding_cache_path: Path = Field("/data/state/embeddings.sqlite", env="EMBEDDING_CACHE_PATH")
+    retry_base_seconds: float = Field(60, env="RETRY_BASE_SECONDS")      # first decode retry
+    retry_max_seconds: float = Field(86400, env="RETRY_MAX_SECONDS")     # backoff ceiling
+    error_backoff_base_seconds: float = Field(5, env="ERROR_BACKOFF_BASE_SECONDS")  # first wait after a failed round
+    error_backoff_max_seconds: float = Field(300, env="ERROR_BACKOFF_MAX_SECONDS")  # … doubling up to this
+    shard_index: int = Field(0, env="SHARD_INDEX")          # this worker's partition …
+    shard_count: int = Field(1, env="SHARD_COUNT")          # … out of this many
+    shard_processes: int = Field(1, env="SHARD_PROCESSES")  # local worker processes (see shards.py)
+    derived_dir: Path = Field("/data/images/.derived", env="DERIVED_DIR")   # downloader's downscaled copies
+    meta_dir: Path = Field("/data/images/.meta", env="META_DIR")             # downloader's per-file source URL
+    spool_dir: Path = Field(spool.SPOOL_DIR, env="SPOOL_DIR")                # downloader → embedder markers
+    spool_poll_seconds: float = Field(1.0, env="SPOOL_POLL_SECONDS")       # marker check interval when idle
+    spool_batch_size: int = Field(256, env="SPOOL_BATCH_SIZE")             # announced files per round
+    full_scan_seconds: float = Field(3600, env="FULL_SCAN_SECONDS")        # safety-net walk of IMAGES_DIR
     log_level: str = Field("INFO", env="LOG_LEVEL")
+
+    @property
+    def sharded(self) -> bool:
+        return self.shard_count > 1
+
+    @property
+    def shard_manifest_path(self) -> Path:
+        """One manifest per shard, so workers never contend on the same file."""
+        if not self.sharded:
+            return self.manifest_path
+        p = self.manifest_path
+        return p.with_name(f"{p.stem}.shard{self.shard_index}of{self.shard_count}{p.suffix}")
+
     @property
     def vector_dim(self) -> int:
         return encoder.embed_dim
@@ -0,0 +1,85 @@
+"""
+Persistent embedding cache keyed by (model name, image sha256).
+
+Every vector the embedder computes is kept here, so rebuilding an index –
+after a mapping change, a lost ES volume, or switching back to a model used
+before – is a bulk copy instead of another CLIP pass over the corpus.
+"""
+
+from __future__ import annotations
+
+import json, sqlite3
+from array import array
+from pathlib import Path
+from typing import Iterable, Iterator
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model   TEXT NOT NULL,
+    digest  TEXT NOT NULL,
+    vector  BLOB NOT NULL,              -- float32, native byte order
+    source  TEXT NOT NULL,              -- JSON of the indexed doc minus `vector`
+    PRIMARY KEY (model, digest)
+)
+"""
+
+
+def _pack(vec: list[float]) -> bytes:
+    return array("f", vec).tobytes()
+
+
+def _unpack(blob: bytes) -> list[float]:
+    vec = array("f")
+    vec.frombytes(blob)
+    return vec.tolist()
+
+
+class EmbeddingStore:
+    """sqlite-backed cache. Like Manifest, use it from one thread only."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # shards share this file: wait for the write lock instead of failing
+        self.conn = sqlite3.connect(str(path), timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(_SCHEMA)
+        self.conn.commit()
+
+    def put_many(self, model: str, docs: Iterable[tuple[str, dict]]):
+        """Store (digest, doc) pairs as produced by the embedder."""
+        rows = [
+            (model, digest, _pack(doc["vector"]),
+             json.dumps({k: v for k, v in doc.items() if k != "vector"}))
+            for digest, doc in docs
+        ]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows,
+            )
+
+    def get_many(self, model: str, digests: list[str], chunk: int = 500) -> dict[str, list[float]]:
+        """Return {digest: vector} for the digests cached under `model`."""
+        found: dict[str, list[float]] = {}
+        for start in range(0, len(digests), chunk):
+            part = digests[start:start + chunk]
+            marks = ",".join("?" * len(part))
+            for digest, blob in self.conn.execute(
+                f"SELECT digest, vector FROM embeddings WHERE model=? AND digest IN ({marks})",
+                (model, *part),
+            ):
+                found[digest] = _unpack(blob)
+        return found
+
+    def iter_model(self, model: str) -> Iterator[tuple[str, dict]]:
+        """Yield (digest, doc) for every vector cached under `model`."""
+        cur = self.conn.execute(
+            "SELECT digest, vector, source FROM embeddings WHERE model=?", (model,),
+        )
+        for digest, blob, source in cur:
+            yield digest, {**json.loads(source), "vector": _unpack(blob)}
+
+    def count(self, model: str) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM embeddings WHERE model=?", (model,),
+        ).fetchone()[0]
@@ -0,0 +1,164 @@
+"""
+On-disk manifest for the embedder.
+
+Keeps one row per image path with the (size, mtime) it was last seen at,
+its sha256 digest and whether it made it into Elasticsearch. A file whose
+size and mtime are unchanged is skipped without being opened; files that
+failed to read or decode are retried with exponential backoff instead of
+every poll.
+"""
+
+from __future__ import annotations
+
+import sqlite3, time
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+INDEXED = "indexed"
+PENDING = "pending"
+FAILED  = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path        TEXT PRIMARY KEY,
+    size        INTEGER NOT NULL,
+    mtime_ns    INTEGER NOT NULL,
+    digest      TEXT,
+    status      TEXT NOT NULL,
+    failures    INTEGER NOT NULL DEFAULT 0,
+    next_retry  REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_digest ON files(digest);
+CREATE TABLE IF NOT EXISTS meta (
+    key    TEXT PRIMARY KEY,
+    value  TEXT NOT NULL
+)
+"""
+
+
+class Entry(NamedTuple):
+    size: int
+    mtime_ns: int
+    digest: str | None
+    status: str
+    failures: int
+    next_retry: float
+
+
+class Manifest:
+    """
+    Thin sqlite wrapper. Not thread-safe: use it from the embedder's main
+    thread only.
+    """
+
+    def __init__(self, path: Path, retry_base: float = 60, retry_max: float = 86400):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+        self.retry_base = retry_base
+        self.retry_max  = retry_max
+
+    def sync_target(self, target: str) -> bool:
+        """
+        Remember which physical index the `indexed` flags refer to. When it
+        changes (model switch, reindex, wiped store) every indexed file goes
+        back to pending – its digest is kept, so nothing is re-hashed.
+        Returns True if the target changed.
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key='target'").fetchone()
+        if row and row[0] == target:
+            return False
+        with self.conn:
+            if row:
+                self.conn.execute(
+                    "UPDATE files SET status=? WHERE status=?", (PENDING, INDEXED),
+                )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('target', ?)", (target,),
+            )
+        return row is not None
+
+    def snapshot(self) -> dict[str, Entry]:
+        """Load every row at once – one query per round instead of one per file."""
+        rows = self.conn.execute(
+            "SELECT path, size, mtime_ns, digest, status, failures, next_retry FROM files"
+        )
+        return {row[0]: Entry(*row[1:]) for row in rows}
+
+    def entries(self, paths: list[str], chunk: int = 500) -> dict[str, Entry]:
+        """Like snapshot(), but only for `paths` – for small incremental rounds."""
+        found: dict[str, Entry] = {}
+        for start in range(0, len(paths), chunk):
+            part = paths[start:start + chunk]
+            marks = ",".join("?" * len(part))
+            for row in self.conn.execute(
+                "SELECT path, size, mtime_ns, digest, status, failures, next_retry "
+                f"FROM files WHERE path IN ({marks})", part,
+            ):
+                found[row[0]] = Entry(*row[1:])
+        return found
+
+    def record(self, entries: Iterable[tuple[str, int, int, str]], status: str = PENDING):
+        """Upsert (path, size, mtime_ns, digest) rows, resetting failure state."""
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO files (path, size, mtime_ns, digest, status, failures, next_retry)
+                VALUES (?, ?, ?, ?, ?, 0, 0)
+                ON CONFLICT(path) DO UPDATE SET
+                    size=excluded.size, mtime_ns=excluded.mtime_ns,
+                    digest=excluded.digest, status=excluded.status,
+                    failures=0, next_retry=0
+                """,
+                [(*e, status) for e in entries],
+            )
+
+    def mark_indexed(self, digests: Iterable[str]):
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE files SET status=?, failures=0, next_retry=0 WHERE digest=?",
+                [(INDEXED, d) for d in digests],
+            )
+
+    def _backoff(self, path: str) -> tuple[int, float]:
+        row = self.conn.execute(
+            "SELECT failures FROM files WHERE path=?", (path,)
+        ).fetchone()
+        failures = (row[0] if row else 0) + 1
+        delay = min(self.retry_base * 2 ** (failures - 1), self.retry_max)
+        return failures, time.time() + delay
+
+    def mark_failed(self, path: str):
+        """Bump the failure counter and push the next attempt out exponentially."""
+        failures, next_retry = self._backoff(path)
+        with self.conn:
+            self.conn.execute(
+                "UPDATE files SET status=?, failures=?, next_retry=? WHERE path=?",
+                (FAILED, failures, next_retry, path),
+            )
+
+    def mark_unreadable(self, path: str, size: int, mtime_ns: int):
+        """Like mark_failed(), for a file that could not even be hashed (no digest)."""
+        failures, next_retry = self._backoff(path)
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO files (path, size, mtime_ns, digest, status, failures, next_retry)
+                VALUES (?, ?, ?, NULL, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    size=excluded.size, mtime_ns=excluded.mtime_ns, digest=NULL,
+                    status=excluded.status, failures=excluded.failures,
+                    next_retry=excluded.next_retry
+                """,
+                (path, size, mtime_ns, FAILED, failures, next_retry),
+            )
+
+    def prune(self, seen: set[str]):
+        """Forget rows for files that no longer exist on disk."""
+        stale = [(p,) for p in self.snapshot() if p not in seen]
+        if stale:
+            with self.conn:
+                self.conn.executemany("DELETE FROM files WHERE path=?", stale)
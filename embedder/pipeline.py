@@ -0,0 +1,176 @@
+"""
+Staged producer/consumer pipeline for the embedder.
+
+    decode pool ──► bounded queue ──► model stage ──► bounded queue ──► ES writer
+    (N threads)                       (caller thread)                   (1 thread)
+
+Decoding JPEGs and running the preprocess transforms happen on a thread
+pool while the model runs on the caller's thread, so the forward pass is
+never waiting on PIL. Finished vectors are handed to a background writer
+that batches them into `_bulk` requests.
+"""
+
+from __future__ import annotations
+
+import logging, queue, threading, time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, NamedTuple
+
+_DONE = object()                    # end-of-stream marker
+
+
+class StageStats:
+    """Items processed and busy time of one stage – enough to spot the bottleneck."""
+
+    def __init__(self, name: str):
+        self.name  = name
+        self.items = 0
+        self.busy  = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, n: int = 1) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            with self._lock:
+                self.items += n
+                self.busy  += elapsed
+
+    def summary(self) -> str:
+        rate = self.items / self.busy if self.busy else 0.0
+        return f"{self.name}: {self.items} in {self.busy:.2f}s busy ({rate:.1f}/s)"
+
+
+class PipelineResult(NamedTuple):
+    indexed: list[str]              # ids written to Elasticsearch
+    failed:  list[Any]              # jobs whose decode step raised
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """Blocking put that gives up once `stop` is set. Returns False if it gave up."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_pipeline(
+    jobs: Iterable[Any],
+    *,
+    decode: Callable[[Any], Any],
+    encode: Callable[[list], list[tuple[str, dict]]],
+    write: Callable[[list[tuple[str, dict]]], list[str]],
+    batch_size: int,
+    bulk_size: int,
+    decode_workers: int = 4,
+    decode_depth: int = 128,
+    write_depth: int = 8,
+) -> PipelineResult:
+    """
+    Push `jobs` through decode → encode → write.
+
+    decode(job)      -> decoded item (raise to mark the job failed)
+    encode(items)    -> [(doc_id, doc), …] for one batch of decoded items
+    write(docs)      -> ids that were indexed
+    """
+    stop     = threading.Event()
+    todo: queue.SimpleQueue = queue.SimpleQueue()
+    decoded  = queue.Queue(maxsize=decode_depth)
+    to_write = queue.Queue(maxsize=write_depth)
+    failed: list[Any] = []
+    indexed: list[str] = []
+    stats = {n: StageStats(n) for n in ("decode", "encode", "write")}
+
+    for job in jobs:
+        todo.put(job)
+    for _ in range(decode_workers):
+        todo.put(_DONE)
+
+    def decode_worker():
+        while not stop.is_set():
+            job = todo.get()
+            if job is _DONE:
+                break
+            try:
+                with stats["decode"].timed():
+                    item = decode(job)
+            except Exception as exc:
+                logging.warning("Cannot decode %s → %s", job, exc)
+                failed.append(job)          # list.append is atomic
+                continue
+            if not _put(decoded, item, stop):
+                return
+        _put(decoded, _DONE, stop)
+
+    def writer():
+        buf: list[tuple[str, dict]] = []
+
+        def flush():
+            try:
+                with stats["write"].timed(len(buf)):
+                    indexed.extend(write(buf))
+            except Exception as exc:
+                logging.exception("Failed writing %d doc(s) → %s", len(buf), exc)
+            buf.clear()
+
+        while True:
+            docs = to_write.get()
+            if docs is _DONE:
+                break
+            buf.extend(docs)
+            if len(buf) >= bulk_size:
+                flush()
+        if buf:
+            flush()
+
+    decoders = [
+        threading.Thread(target=decode_worker, name=f"decode-{i}", daemon=True)
+        for i in range(decode_workers)
+    ]
+    write_thread = threading.Thread(target=writer, name="es-writer", daemon=True)
+    for t in (*decoders, write_thread):
+        t.start()
+
+    t0 = time.perf_counter()
+    batch: list = []
+
+    def flush_batch():
+        try:
+            with stats["encode"].timed(len(batch)):
+                docs = encode(batch)
+        except Exception as exc:
+            logging.exception("Failed on batch of %d → %s", len(batch), exc)
+        else:
+            to_write.put(docs)
+        batch.clear()
+
+    try:
+        remaining = decode_workers
+        while remaining:
+            item = decoded.get()
+            if item is _DONE:
+                remaining -= 1
+                continue
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush_batch()
+        if batch:
+            flush_batch()
+    finally:
+        stop.set()
+        to_write.put(_DONE)
+        write_thread.join()
+
+    wall = time.perf_counter() - t0
+    if stats["decode"].items or failed:
+        logging.info(
+            "pipeline %.2fs wall │ %s │ %s │ %s",
+            wall, *(s.summary() for s in stats.values()),
+        )
+    return PipelineResult(indexed=indexed, failed=failed)
@@ -0,0 +1,70 @@
+"""
+Rebuild the Elasticsearch index from the embedding cache – no inference.
+
+A new versioned index (ES_INDEX_<model>_<ts>) is created with the current
+mapping settings and bulk-loaded from every vector cached for MODEL while
+the alias keeps serving the old index. The alias is then swapped in one
+atomic `_aliases` call. Files embedded after the copy started are picked up
+by the worker's next round (it notices the new index and re-checks).
+
+On a deployment from before aliases, ES_INDEX is still a concrete index:
+the same `_aliases` call deletes it, so --keep-old cannot apply there.
+
+Usage (inside the embedder container)
+-----
+python -m reindex               # build, swap, delete the old index
+python -m reindex --keep-old    # leave the previous index in place
+"""
+
+import argparse, logging, sys, time
+
+from config import settings
+from embedding_store import EmbeddingStore
+from common.models import encoder
+from common.es_utils import (
+    ES_INDEX, get_es_client, create_versioned_index, swap_alias, bulk_index,
+    refresh_disabled, is_concrete_index,
+)
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Rebuild the vector index from cached embeddings")
+    ap.add_argument("--keep-old", action="store_true", help="do not delete the replaced index")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=settings.log_level, format="%(asctime)s  %(levelname)-8s %(message)s")
+
+    cache = EmbeddingStore(settings.embedding_cache_path)
+    total = cache.count(encoder.name)
+    if not total:
+        logging.error("No cached embeddings for model %s – nothing to rebuild from", encoder.name)
+        return 1
+
+    es  = get_es_client()
+    if is_concrete_index(es, ES_INDEX):
+        if args.keep_old:
+            logging.error(
+                "%s is a concrete index, not an alias: it has to be replaced by the "
+                "alias, so it cannot be kept – rerun without --keep-old", ES_INDEX,
+            )
+            return 1
+        logging.info("%s is a concrete index – it will be replaced by an alias of the same name", ES_INDEX)
+    new = create_versioned_index(es, ES_INDEX)
+    logging.info("Copying %d cached vector(s) into %s", total, new)
+
+    t0 = time.perf_counter()
+    with refresh_disabled(es, new):
+        written = bulk_index(es, new, cache.iter_model(encoder.name), settings.bulk_chunk_size)
+    logging.info("Indexed %d/%d doc(s) in %.1fs", len(written), total, time.perf_counter() - t0)
+
+    old = swap_alias(es, ES_INDEX, new)
+    logging.info("Alias %s → %s (was %s)", ES_INDEX, new, ", ".join(old) or "–")
+    if not args.keep_old:
+        for index in old:
+            es.indices.delete(index=index)
+            logging.info("Deleted %s", index)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""
+Run several embedder workers on one host.
+
+Each child is a normal `python -m worker` with its own SHARD_INDEX, so it
+owns a fixed slice of IMAGES_DIR (path hash mod SHARD_COUNT) and its own
+manifest. The host-level SHARD_INDEX / SHARD_COUNT still apply: host h of
+H running P processes hands out global shards h·P … h·P+P-1 out of H·P.
+Unless INTRA_OP_THREADS is set, the cores are split evenly between the
+children so they do not oversubscribe the CPU. With METRICS_PORT set,
+child i serves /metrics on METRICS_PORT + i.
+
+Usage (the embedder image's default command)
+-----
+SHARD_PROCESSES=4 python -m shards
+SHARD_INDEX=1 SHARD_COUNT=2 SHARD_PROCESSES=4 python -m shards   # 2nd of 2 hosts
+"""
+
+import logging, os, signal, subprocess, sys
+
+from config import settings
+
+
+def main() -> int:
+    n = max(settings.shard_processes, 1)
+    if n == 1:
+        os.execvp(sys.executable, [sys.executable, "-u", "-m", "worker"])
+
+    logging.basicConfig(level=settings.log_level, format="%(asctime)s  %(levelname)-8s %(message)s")
+    threads = os.getenv("INTRA_OP_THREADS") or str(max((os.cpu_count() or n) // n, 1))
+    count   = settings.shard_count * n
+    port    = int(os.getenv("METRICS_PORT", 0))
+
+    children = []
+    for i in range(n):
+        index = settings.shard_index * n + i
+        env = {
+            **os.environ,
+            "SHARD_INDEX":      str(index),
+            "SHARD_COUNT":      str(count),
+            "SHARD_PROCESSES":  "1",
+            "INTRA_OP_THREADS": threads,
+            "METRICS_PORT":     str(port + i if port else 0),
+        }
+        children.append(subprocess.Popen([sys.executable, "-u", "-m", "worker"], env=env))
+        logging.info("Started shard %d/%d (pid %d, %s thread(s))", index, count, children[-1].pid, threads)
+
+    stopping = False
+
+    def forward(signum, _frame):
+        nonlocal stopping
+        stopping = True
+        for child in children:
+            child.send_signal(signum)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    # one shard dying means part of the corpus is no longer ingested:
+    # stop the rest and let the container restart policy bring us back
+    pid, status = os.wait()
+    code = os.waitstatus_to_exitcode(status)
+    if not stopping:
+        logging.warning("Shard process %d exited with %d – stopping the others", pid, code)
+    for child in children:
+        if child.poll() is None:
+            child.terminate()
+    for child in children:
+        child.wait()
+    return 0 if stopping else (code or 1)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,23 +1,31 @@
 """
-Embedder – poll mode
-Re‑walk the shared images volume every POLL_SECONDS seconds, create
-embeddings for files that are not yet in Elasticsearch, then sleep.
+Embedder – event-driven
+Embed the files the downloader announces through the spool directory
+(common/spool.py) as soon as they land, checking for new markers every
+SPOOL_POLL_SECONDS. A full walk of the shared images volume runs at startup
+and every FULL_SCAN_SECONDS to catch anything written by other means.
+Files whose size and mtime match the local manifest are skipped unread.
+With SHARD_COUNT > 1 this process only handles the files whose path hashes
+to SHARD_INDEX (see shards.py for running several on one host).
 """
 
-import hashlib, logging, os, time
+import hashlib, json, logging, os, signal, time
+from contextlib import nullcontext
 from pathlib import Path
 from typing import Iterable
 
 import torch
 from PIL import Image
-from tqdm import tqdm
 
 from config import settings
+from manifest import Manifest, INDEXED, FAILED
+from embedding_store import EmbeddingStore
+from pipeline import run_pipeline
 from common.models import encoder                      # singleton
-from common.es_utils import ensure_index_exists, get_es_client, ES_INDEX
+from common.backends import get_backend
+from common import spool, metrics
 
 # ── tunables ──────────────────────────────────────────────────────────────
-POLL_SECONDS = int(os.getenv("POLL_SECONDS", 30))
 IMAGES_DIR   = Path(settings.images_dir)               # usually /data/images
 # ──────────────────────────────────────────────────────────────────────────
 
@@ -27,12 +35,27 @@ logging.basicConfig(
     format="%(asctime)s  %(levelname)-8s %(message)s",
 )
 
-# ── model + Elasticsearch -------------------------------------------------
+# ── metrics (served by the sidecar started in main_loop) ------------------
+EMBEDDED = metrics.Counter("embedder_images_indexed_total", "Images written to the vector store")
+FAILED_N = metrics.Counter("embedder_images_failed_total", "Images that failed to decode")
+REUSED   = metrics.Counter("embedder_images_reused_total", "Vectors re-used from the embedding cache")
+ROUND_S  = metrics.Histogram(
+    "embedder_round_seconds", "Wall time of one embedder round", ["kind"], buckets=metrics.BUCKETS,
+)
+
+# ── model + vector store --------------------------------------------------
 device = "cuda" if torch.cuda.is_available() else "cpu"
-encoder.model.to(device)
+encoder.to(device)                                     # loads the (image-tower) weights
 
-es = get_es_client()
-ensure_index_exists(es, ES_INDEX)                      # guarantees correct dims
+store = get_backend()                                  # Elasticsearch or NumPy (VECTOR_BACKEND)
+store.ensure_index()                                   # same model + dims; safe from every shard at once
+
+manifest = Manifest(
+    settings.shard_manifest_path,
+    retry_base=settings.retry_base_seconds,
+    retry_max=settings.retry_max_seconds,
+)
+cache = EmbeddingStore(settings.embedding_cache_path)  # (model, sha256) → vector
 
 # ── helpers ---------------------------------------------------------------
 def sha256_bytes(fp) -> str:
@@ -42,46 +65,275 @@ def sha256_bytes(fp) -> str:
     fp.seek(0)
     return h.hexdigest()
 
-def iter_images() -> Iterable[Path]:
-    return IMAGES_DIR.rglob("*.[jp][pn]g")
-
-def embed_and_index(img_path: Path) -> bool:
-    """Return True if a new document was written, False otherwise."""
-    with img_path.open("rb") as f:
-        digest = sha256_bytes(f)
-        if es.exists(index=ES_INDEX, id=digest):
-            return False                            # already indexed
-
-        img = Image.open(f).convert("RGB")
-        vec = encoder.image(img)                    # returns list[float] of embed_dim
-        doc = {"path": str(img_path), "vector": vec}
-        es.index(index=ES_INDEX, id=digest, document=doc)
+def in_shard(img_path: Path) -> bool:
+    """Deterministic partition by relative path – decided without opening the file."""
+    if not settings.sharded:
         return True
+    rel = str(img_path.relative_to(IMAGES_DIR)).encode()
+    h = int.from_bytes(hashlib.blake2b(rel, digest_size=8).digest(), "big")
+    return h % settings.shard_count == settings.shard_index
 
-# ── main loop -------------------------------------------------------------
-def run_once() -> int:
-    """Embed any not‑yet‑indexed images. Return number processed."""
-    images = list(iter_images())
-    new_count = 0
+def iter_images() -> Iterable[Path]:
+    # hidden dirs hold the downloader's spool, temp files and derivatives
+    return (
+        p for p in IMAGES_DIR.rglob("*.[jp][pn]g")
+        if not any(part.startswith(".") for part in p.relative_to(IMAGES_DIR).parts)
+        and in_shard(p)
+    )
+
+def spooled() -> list[str]:
+    """Announced files that belong to this shard, oldest first."""
+    return [n for n in spool.pending(settings.spool_dir) if in_shard(IMAGES_DIR / n)]
+
+def hash_file(img_path: Path) -> str:
+    with metrics.stage("hash"), img_path.open("rb") as f:
+        return sha256_bytes(f)
 
-    for img_path in tqdm(images, desc="Embedding", leave=False):
+def find_missing(paths: list[Path], full: bool = True) -> list[tuple[str, Path]]:
+    """
+    Return (digest, path) for files that still need embedding.
+
+    Files unchanged since the last round (same size + mtime in the manifest)
+    are decided from the manifest alone. Only new or modified files are
+    hashed; they and any pending digests are checked against the store once
+    per `check_chunk_size` files. `full` means `paths` is the whole shard,
+    so manifest rows for anything else can be pruned.
+    """
+    known = manifest.snapshot() if full else manifest.entries([str(p) for p in paths])
+    now = time.time()
+    missing: list[tuple[str, Path]] = []
+    changed: list[tuple[Path, os.stat_result]] = []
+    to_check: list[tuple[str, Path]] = []
+
+    for img_path in paths:
         try:
-            if embed_and_index(img_path):
-                new_count += 1
-        except Exception as exc:
-            logging.exception("Failed on %s → %s", img_path, exc)
+            st = img_path.stat()
+        except OSError as exc:
+            logging.warning("Cannot stat %s → %s", img_path, exc)
+            continue
+        entry = known.get(str(img_path))
+        if entry is None or (entry.size, entry.mtime_ns) != (st.st_size, st.st_mtime_ns):
+            changed.append((img_path, st))
+        elif entry.status == INDEXED:
+            continue
+        elif entry.status == FAILED:
+            if entry.next_retry > now:                # still backing off
+                continue
+            if entry.digest is None:                  # could not be read last time
+                changed.append((img_path, st))
+            else:
+                missing.append((entry.digest, img_path))
+        else:
+            to_check.append((entry.digest, img_path))  # digest known, no re-hash
+
+    step = settings.check_chunk_size
+    for start in range(0, len(changed), step):
+        rows: list[tuple[str, int, int, str]] = []
+        for img_path, st in changed[start:start + step]:
+            try:
+                rows.append((str(img_path), st.st_size, st.st_mtime_ns, hash_file(img_path)))
+            except Exception as exc:
+                logging.warning("Cannot hash %s → %s", img_path, exc)
+                manifest.mark_unreadable(str(img_path), st.st_size, st.st_mtime_ns)
+        manifest.record(rows)
+        to_check.extend((r[3], Path(r[0])) for r in rows)
+
+    for start in range(0, len(to_check), step):
+        part = to_check[start:start + step]
+        stored = store.existing_ids(list({d for d, _ in part}))
+        manifest.mark_indexed(stored)
+        missing.extend((d, p) for d, p in part if d not in stored)
 
-    return new_count
+    if full:
+        manifest.prune({str(p) for p in paths})
+    unique: dict[str, Path] = {}
+    for digest, img_path in missing:
+        unique.setdefault(digest, img_path)          # same bytes → one vector
+    return list(unique.items())
+
+def decode_source(img_path: Path) -> Path:
+    """The downloader's downscaled derivative if it wrote one, else the original."""
+    derived = settings.derived_dir / img_path.relative_to(IMAGES_DIR)
+    return derived if derived.exists() else img_path
+
+def describe(img_path: Path) -> dict:
+    """
+    Filterable metadata indexed next to the vector (common/filters.py): the
+    source URL from the downloader's sidecar, pixel size from the image
+    header (no decode), file size and ingest time.
+    """
+    meta: dict = {"indexed_at": int(time.time())}
+    try:
+        meta["bytes"] = img_path.stat().st_size
+        side = json.loads((settings.meta_dir / f"{img_path.relative_to(IMAGES_DIR)}.json").read_text())
+        meta.update(url=side["url"], domain=side["domain"])
+    except (OSError, ValueError, KeyError):
+        pass                                          # gone, or not fetched by the downloader
+    try:
+        with Image.open(img_path) as img:
+            meta.update(width=img.width, height=img.height)
+    except Exception:
+        pass
+    return meta
+
+def decode(job: tuple[str, Path]) -> tuple[str, Path, torch.Tensor, dict]:
+    """Pipeline decode stage: read + preprocess one file into a tensor."""
+    digest, img_path = job
+    return digest, img_path, encoder.preprocess_image(decode_source(img_path)), describe(img_path)
+
+def embed_batch(batch: list[tuple[str, Path, torch.Tensor, dict]]) -> list[tuple[str, dict]]:
+    """Pipeline model stage: encode a batch of preprocessed tensors in one forward pass."""
+    vecs = encoder.encode_tensors([tensor for _, _, tensor, _ in batch])
+    docs = [
+        (digest, {"path": str(img_path), **meta, "vector": vec})
+        for (digest, img_path, _, meta), vec in zip(batch, vecs)
+    ]
+    with metrics.stage("cache_put", len(docs)):
+        cache.put_many(encoder.name, docs)          # never pay for this vector twice
+    return docs
+
+def write_docs(docs: list[tuple[str, dict]]) -> list[str]:
+    """Pipeline writer stage."""
+    with metrics.stage("index", len(docs)):
+        return store.bulk_index(docs, settings.bulk_chunk_size)
+
+# ── main loop -------------------------------------------------------------
+class Unwritten(RuntimeError):
+    """Some documents of a round never reached the store (encode or write error)."""
+
+    def __init__(self, paths: list[Path]):
+        super().__init__(f"{len(paths)} image(s) were not written to the vector store")
+        self.paths = paths
+
+def run_once(paths: list[Path] | None = None) -> int:
+    """
+    Embed any not‑yet‑indexed images (or only `paths`). Return number processed.
+    Raises Unwritten (after recording everything that did succeed) when some
+    images were neither indexed nor failed to decode.
+    """
+    if manifest.sync_target(store.target()):
+        logging.info("Vector index changed – re-checking every file against it")
+        paths = None
+    full = paths is None
+    missing = find_missing(list(iter_images()) if full else paths, full=full)
+    if not missing:
+        if full:
+            store.promote(settings.shard_index, settings.shard_count)
+        return 0
+
+    # vectors this model already produced once only need to be re-written
+    cached = cache.get_many(encoder.name, [d for d, _ in missing])
+    todo   = [(d, p) for d, p in missing if d not in cached]
+
+    # refresh is index-wide: only shard 0 toggles it, so shards never fight over it
+    backfill = len(missing) >= settings.backfill_threshold and settings.shard_index == 0
+    with store.bulk_mode() if backfill else nullcontext():
+        reused = write_docs([
+            (d, {"path": str(p), **describe(p), "vector": cached[d]}) for d, p in missing if d in cached
+        ]) if cached else []
+        result = run_pipeline(
+            todo,
+            decode=decode,
+            encode=embed_batch,
+            write=write_docs,
+            batch_size=settings.batch_size,
+            bulk_size=settings.bulk_chunk_size,
+            decode_workers=settings.decode_workers,
+            decode_depth=settings.decode_queue_depth,
+            write_depth=settings.write_queue_depth,
+        )
+
+    manifest.mark_indexed(reused + result.indexed)
+    for _, img_path in result.failed:
+        manifest.mark_failed(str(img_path))
+    EMBEDDED.inc(len(reused) + len(result.indexed))
+    REUSED.inc(len(reused))
+    FAILED_N.inc(len(result.failed))
+    if reused:
+        logging.info("Re-used %d cached embedding(s)", len(reused))
+    done = {*reused, *result.indexed, *(d for d, _ in result.failed)}
+    unwritten = [p for d, p in missing if d not in done]
+    if unwritten:
+        raise Unwritten(unwritten)
+    if full:
+        store.promote(settings.shard_index, settings.shard_count)
+    return len(reused) + len(result.indexed)
+
+def guarded(kind: str, names: list[str], paths: list[Path] | None = None) -> int | None:
+    """
+    One round; an error (ES down or timing out, …) is logged instead of
+    ending the process. Announced `names` are only acked once handled: after
+    a clean round, or – if only some images could not be written – all but those.
+    """
+    try:
+        with ROUND_S.labels(kind).time():
+            added = run_once(paths)
+    except Unwritten as exc:
+        logging.error("%s round incomplete → %s", kind.capitalize(), exc)
+        left = {str(p.relative_to(IMAGES_DIR)) for p in exc.paths}
+        spool.ack([n for n in names if n not in left], settings.spool_dir)
+        return None
+    except Exception:
+        logging.exception("%s round failed", kind.capitalize())
+        return None
+    spool.ack(names, settings.spool_dir)
+    return added
 
 def main_loop():
-    logging.info("Embedder started – polling every %s s", POLL_SECONDS)
+    logging.info(
+        "Embedder started – shard %d/%d, spool %s, full scan every %s s",
+        settings.shard_index, settings.shard_count, settings.spool_dir,
+        settings.full_scan_seconds,
+    )
+    metrics.serve()
+    next_scan = 0.0
+    errors = 0
     while True:
-        added = run_once()
+        if errors:
+            delay = min(settings.error_backoff_base_seconds * 2 ** (errors - 1), settings.error_backoff_max_seconds)
+            logging.warning("Retrying in %.0f s (%d failed round(s) in a row)", delay, errors)
+            time.sleep(delay)
+
+        if time.monotonic() >= next_scan:
+            # markers seen now are covered by the walk; later ones are not
+            try:
+                names = spooled()
+            except OSError:
+                names = []                            # markers stay, next round acks them
+            added = guarded("full", names)
+            if added is None:
+                errors += 1
+                continue
+            errors = 0
+            next_scan = time.monotonic() + settings.full_scan_seconds
+            if added:
+                logging.info("✓ full scan complete – %d new embedding(s)", added)
+            continue
+
+        try:
+            names = spooled()[:settings.spool_batch_size]
+        except OSError:
+            logging.exception("Cannot read the spool")
+            errors += 1
+            continue
+        if not names:
+            time.sleep(settings.spool_poll_seconds)
+            continue
+        added = guarded("spool", names, [IMAGES_DIR / n for n in names])
+        if added is None:
+            errors += 1
+            continue
+        errors = 0
         if added:
-            logging.info("✓ round complete – %d new embedding(s)", added)
-        time.sleep(POLL_SECONDS)
+            logging.info("✓ %d new embedding(s) from %d announced file(s)", added, len(names))
+
+def stop(_signum, _frame):
+    """SIGTERM (docker stop, shards.py) unwinds like Ctrl-C, so `finally` blocks
+    – e.g. restoring refresh_interval after a backfill – still run."""
+    raise KeyboardInterrupt
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, stop)
     try:
         main_loop()
     except KeyboardInterrupt:
@@ -0,0 +1,70 @@
+"""
+Dynamic micro-batching for the search API.
+
+Concurrent requests each submit one item; items arriving within
+`window_ms` (or until `max_batch` are queued) are handed to a single
+batched call, and every caller gets back its own result.
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+class MicroBatcher:
+    """
+    Coalesce single-item awaits into list-in / list-out calls of `fn`.
+
+    `fn(items)` must return one result per item, in order. A result that is
+    an exception instance is raised in that caller only; if `fn` itself
+    raises, every caller in the batch sees the error.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[list], Awaitable[list]],
+        max_batch: int = 32,
+        window_ms: float = 3.0,
+    ):
+        self.fn        = fn
+        self.max_batch = max_batch
+        self.window    = window_ms / 1000
+        self._pending: list[tuple[Any, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        fut  = loop.create_future()
+        self._pending.append((item, fut))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)                 # keep a reference until done
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[Any, asyncio.Future]]):
+        try:
+            results = await self.fn([item for item, _ in batch])
+        except Exception as exc:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+        for (_, fut), res in zip(batch, results):
+            if fut.done():                        # caller went away
+                continue
+            if isinstance(res, BaseException):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
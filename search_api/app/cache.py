@@ -0,0 +1,98 @@
+"""
+Small in-process caches for the search API.
+
+* LRUCache – bounded, optional TTL, keeps hit/miss counters and an
+  approximate byte size so /meta can report them.
+* vector_key – compact hashable key for a query vector.
+"""
+from __future__ import annotations
+
+import hashlib, sys, time
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+def vector_key(vec: list[float]) -> bytes:
+    """16-byte digest of a float vector – cheaper to store than tuple(vec)."""
+    return hashlib.blake2b(array("f", vec).tobytes(), digest_size=16).digest()
+
+
+def normalize_prompt(text: str) -> str:
+    """CLIP's tokenizer lower-cases and collapses whitespace, so we can too."""
+    return " ".join(text.lower().split())
+
+
+def _deep_sizeof(obj: Any) -> int:
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k) + _deep_sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_sizeof(x) for x in obj)
+    return size
+
+
+class LRUCache:
+    """
+    Least-recently-used mapping with a fixed number of entries.
+    `ttl` (seconds, 0 = never) expires entries lazily on read.
+    Not thread-safe – use it from the event loop only.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float = 0,
+        sizeof: Callable[[Any], int] = _deep_sizeof,
+    ):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.sizeof  = sizeof
+        self.hits    = 0
+        self.misses  = 0
+        self.bytes   = 0
+        self._data: OrderedDict[Hashable, tuple[float, int, Any]] = OrderedDict()
+
+    def get(self, key: Hashable):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        stored_at, size, value = entry
+        if self.ttl and time.monotonic() - stored_at > self.ttl:
+            self._drop(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value):
+        if self.maxsize <= 0:
+            return
+        if key in self._data:
+            self._drop(key)
+        size = self.sizeof(value)
+        self._data[key] = (time.monotonic(), size, value)
+        self.bytes += size
+        while len(self._data) > self.maxsize:
+            self._drop(next(iter(self._data)))
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def _drop(self, key: Hashable):
+        _, size, _ = self._data.pop(key)
+        self.bytes -= size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries":  len(self._data),
+            "maxsize":  self.maxsize,
+            "hits":     self.hits,
+            "misses":   self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "bytes":    self.bytes,
+        }
@@ -3,9 +3,33 @@ Centralized defaults so they can be overridden via env-vars
 in docker-compose.yml or the host shell.
 """
 import os
+from pathlib import Path
 
 ES_HOST        = os.getenv("ES_HOST",  "http://es:9200")
 ES_INDEX       = os.getenv("ES_INDEX", "images")
 TOP_K_DEFAULT  = int(os.getenv("TOP_K",  10))
 NUM_CANDIDATES = int(os.getenv("NUM_CANDIDATES", 100))
 DEVICE = os.getenv("DEVICE", "cpu")
+MODEL  = os.getenv("MODEL", "RN50")
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 2))   # threads running CLIP off the event loop
+SEARCH_WORKERS    = int(os.getenv("SEARCH_WORKERS", 1))      # API processes forked from one preloaded model
+SEARCH_HOST       = os.getenv("SEARCH_HOST", "0.0.0.0")
+SEARCH_PORT       = int(os.getenv("SEARCH_PORT", 8000))
+BATCH_WINDOW_MS   = float(os.getenv("BATCH_WINDOW_MS", 3))    # how long to gather concurrent queries
+BATCH_MAX         = int(os.getenv("BATCH_MAX", 32))           # flush early at this many
+TEXT_CACHE_SIZE   = int(os.getenv("TEXT_CACHE_SIZE", 4096))     # prompt → vector entries
+TEXT_CACHE_TTL    = float(os.getenv("TEXT_CACHE_TTL", 0))       # seconds, 0 = no expiry
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 2048))   # (vector, k, candidates) → hits
+RESULT_CACHE_TTL  = float(os.getenv("RESULT_CACHE_TTL", 300))
+VECTOR_CACHE_SIZE = int(os.getenv("VECTOR_CACHE_SIZE", 4096))   # doc id → stored vector (/search/similar)
+INDEX_CHECK_SECONDS = float(os.getenv("INDEX_CHECK_SECONDS", 5))  # result-cache invalidation poll
+SEARCH_BATCH_MAX   = int(os.getenv("SEARCH_BATCH_MAX", 1000))   # queries per /search/*/batch request
+SEARCH_BATCH_CHUNK = int(os.getenv("SEARCH_BATCH_CHUNK", 64))   # queries per encode + _msearch step
+PAGE_PREFETCH     = int(os.getenv("PAGE_PREFETCH", 5))          # pages fetched per kNN round when paging
+MAX_RESULT_WINDOW = 10_000                                      # ES index.max_result_window
+IMAGES_DIR    = Path(os.getenv("IMAGES_DIR", "/data/images"))
+THUMB_DIR     = Path(os.getenv("THUMB_DIR", "/data/thumbs"))      # resized copies, safe to wipe
+THUMB_WIDTHS  = sorted(int(w) for w in os.getenv("THUMB_WIDTHS", "128,256,512").split(","))
+THUMB_QUALITY = int(os.getenv("THUMB_QUALITY", 80))
+THUMB_MAX_AGE = int(os.getenv("THUMB_MAX_AGE", 86400))           # Cache-Control max-age, seconds
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 0))            # log requests slower than this, 0 = off
@@ -1,103 +1,496 @@
-from fastapi import FastAPI, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 
-import os
+import asyncio, json, logging, math, time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 # local deps
-from .schemas import TextQuery
-from .config  import ES_INDEX, TOP_K_DEFAULT, NUM_CANDIDATES, DEVICE
+from .schemas import TextQuery, TextBatchQuery, SimilarBatchQuery
+from .batching import MicroBatcher
+from .cache   import LRUCache, normalize_prompt, vector_key
+from .paging  import Cursor
+from .config  import (
+    ES_INDEX, TOP_K_DEFAULT, NUM_CANDIDATES, DEVICE, MODEL, INFERENCE_WORKERS,
+    BATCH_WINDOW_MS, BATCH_MAX,
+    TEXT_CACHE_SIZE, TEXT_CACHE_TTL, RESULT_CACHE_SIZE, RESULT_CACHE_TTL,
+    VECTOR_CACHE_SIZE, INDEX_CHECK_SECONDS, IMAGES_DIR, THUMB_MAX_AGE,
+    SEARCH_BATCH_MAX, SEARCH_BATCH_CHUNK, SLOW_QUERY_MS,
+    PAGE_PREFETCH, MAX_RESULT_WINDOW,
+)
+from . import thumbs
 
 # shared utils
 from common.models   import encoder
-from common.es_utils import get_es_client, ensure_index_exists, knn_search
+from common.backends import get_backend
+from common import filters, metrics
 
 
 app = FastAPI(
     title       = "Image-Search-API",
     version     = "1.0.0",
-    description = "k-NN search over image embeddings stored in Elasticsearch",
+    description = "k-NN search over image embeddings (Elasticsearch or in-process NumPy)",
 )
 
-# -------------------------- ES client + index -------------------------------------
-es = get_es_client()                 # one client per process
-ensure_index_exists(es, ES_INDEX)    # create / fix mapping on startup
+# -------------------------- vector store ------------------------------------------
+store = get_backend()                # Elasticsearch or NumPy (VECTOR_BACKEND)
+store.ensure_index()                 # create / fix mapping on startup
 
 # -------------------------- ensure encoder on right device ------------------------
-encoder.model.to(DEVICE)
+encoder.to(DEVICE)                   # loads the weights before the first request
 
+# -------------------------- model executor ----------------------------------------
+# CLIP forward passes are CPU-bound; run them on a small dedicated pool so the
+# event loop keeps serving other requests (and /healthz) meanwhile.
+model_pool = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="clip")
 
-# ─────────────────────────── ROUTES ──────────────────────────
-@app.post("/search/text")
-async def search_text(body: TextQuery):
+
+async def run_model(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(model_pool, partial(fn, *args))
+
+
+# -------------------------- micro-batchers ----------------------------------------
+# Concurrent requests are coalesced: prompts into one encoder.text() call,
+# kNN queries into one _msearch round trip.
+text_batcher = MicroBatcher(
+    lambda prompts: run_model(encoder.text, prompts),
+    max_batch=BATCH_MAX, window_ms=BATCH_WINDOW_MS,
+)
+async def knn_msearch(queries):
+    with metrics.stage("knn_msearch", len(queries), trace=False):
+        return await store.knn_msearch_async(queries, source_fields=["path"])
+
+knn_batcher = MicroBatcher(knn_msearch, max_batch=BATCH_MAX, window_ms=BATCH_WINDOW_MS)
+
+
+# -------------------------- metrics / tracing -------------------------------------
+REQUEST_S = metrics.Histogram(
+    "search_api_request_seconds", "End-to-end request time",
+    ["route", "method", "status"], buckets=metrics.BUCKETS,
+)
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """X-Request-ID in and out, request histogram, slow-request log with stage breakdown."""
+    trace    = metrics.start_trace(request.headers.get("x-request-id"))
+    response = await call_next(request)
+    elapsed  = trace.elapsed_ms()
+    route    = getattr(request.scope.get("route"), "path", "unmatched")
+    REQUEST_S.labels(route, request.method, response.status_code).observe(elapsed / 1000)
+    response.headers["X-Request-ID"] = trace.id
+    if SLOW_QUERY_MS and elapsed > SLOW_QUERY_MS and route != "/metrics":
+        logging.warning(
+            "slow request %s %s %.1f ms trace=%s %s",
+            request.method, request.url.path, elapsed, trace.id, trace.breakdown(),
+        )
+    return response
+
+
+# -------------------------- caches ------------------------------------------------
+# Prompt vectors never go stale for a given model. Search results do, so the
+# result cache is cleared whenever the index fingerprint changes.
+text_cache   = LRUCache(TEXT_CACHE_SIZE, ttl=TEXT_CACHE_TTL)
+result_cache = LRUCache(RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+vector_cache = LRUCache(VECTOR_CACHE_SIZE)       # ids are content hashes: vectors never change
+index_generation: tuple | None = None
+
+
+async def watch_index():
+    global index_generation
+    while True:
+        try:
+            gen = await store.generation_async()
+        except Exception as exc:
+            logging.warning("Index stats failed → %s", exc)
+        else:
+            if gen != index_generation:
+                result_cache.clear()
+                index_generation = gen
+        await asyncio.sleep(INDEX_CHECK_SECONDS)
+
+
+async def embed_text(prompt: str) -> list[float]:
+    key = (MODEL, normalize_prompt(prompt))
+    vec = text_cache.get(key)
+    if vec is None:
+        vec = await text_batcher.submit(prompt)
+        text_cache.put(key, vec)
+    return vec
+
+
+def result_key(vec: list[float], k: int, candidates: int, spec: dict | None = None) -> tuple:
+    return (vector_key(vec), k, candidates, filters.key(spec))
+
+
+async def search_vector(
+    vec: list[float], k: int, candidates: int | None = None,
+    spec: dict | None = None, offset: int = 0,
+) -> list[dict]:
+    """
+    Hits offset … offset + k. Later pages fetch PAGE_PREFETCH pages' worth
+    in one kNN query, so following a cursor mostly hits the result cache.
+    """
+    candidates = candidates or NUM_CANDIDATES
+    fetch = k
+    if offset:
+        step  = k * PAGE_PREFETCH
+        fetch = min(math.ceil((offset + k) / step) * step, MAX_RESULT_WINDOW)
+    key  = result_key(vec, fetch, candidates, spec)
+    hits = result_cache.get(key)
+    if hits is None:
+        hits = await knn_batcher.submit((vec, fetch, candidates, spec))
+        result_cache.put(key, hits)
+    return hits[offset:offset + k]
+
+
+# -------------------------- batch search ------------------------------------------
+# Offline jobs send many queries at once: encode them in one forward pass and
+# run the kNN queries in one _msearch per chunk, skipping anything cached.
+async def embed_texts(prompts: list[str]) -> list[list[float]]:
+    keys = [normalize_prompt(p) for p in prompts]
+    vecs = {key: text_cache.get((MODEL, key)) for key in keys}
+    todo = [key for key, vec in vecs.items() if vec is None]
+    if todo:
+        for key, vec in zip(todo, await run_model(encoder.text, todo)):
+            text_cache.put((MODEL, key), vec)
+            vecs[key] = vec
+    return [vecs[key] for key in keys]
+
+
+def encode_uploads(blobs: list[bytes | Exception]) -> list[list[float] | Exception]:
+    """Decode each upload on its own (a bad file fails alone), then one forward pass."""
+    tensors: list = []
+    for blob in blobs:
+        try:
+            if isinstance(blob, Exception):
+                raise blob
+            tensors.append(encoder.preprocess_image(blob))
+        except Exception as exc:
+            tensors.append(exc if isinstance(exc, ValueError) else ValueError(f"Cannot decode image: {exc}"))
+    ok   = [t for t in tensors if not isinstance(t, Exception)]
+    vecs = iter(encoder.encode_tensors(ok))
+    return [t if isinstance(t, Exception) else next(vecs) for t in tensors]
+
+
+async def search_many(queries: list[tuple]) -> list[list[dict] | Exception]:
+    """(vector, k, candidates[, filter spec]) queries, one _msearch for the uncached ones."""
+    keys    = [result_key(*query) for query in queries]
+    results = [result_cache.get(key) for key in keys]
+    todo    = [i for i, hits in enumerate(results) if hits is None]
+    if todo:
+        with metrics.stage("knn_msearch", len(todo)):
+            fresh = await store.knn_msearch_async([queries[i] for i in todo], source_fields=["path"])
+        for i, hits in zip(todo, fresh):
+            if not isinstance(hits, Exception):
+                result_cache.put(keys[i], hits)
+            results[i] = hits
+    return results
+
+
+async def batch_rows(
+    items: list, encode, params: list[tuple], exclude: list[str] | None = None,
+):
     """
-    Encode user prompt → CLIP vector → k-NN in Elasticsearch.
+    Yield {"index", "hits"} / {"index", "error"} rows in input order, one chunk
+    of SEARCH_BATCH_CHUNK at a time. The next chunk is encoded while the
+    current one is being searched. params[i] is (k, candidates[, filter
+    spec]) for item i. With `exclude`, each query asked for one
+    extra hit and the document exclude[i] is removed from row i.
     """
-    k   = body.k or TOP_K_DEFAULT
-    vec = encoder.text(body.text)
+    if not items:
+        return
+    chunks  = [items[i:i + SEARCH_BATCH_CHUNK] for i in range(0, len(items), SEARCH_BATCH_CHUNK)]
+    pending = asyncio.ensure_future(encode(chunks[0]))
+    for n, chunk in enumerate(chunks):
+        vecs = await pending
+        if n + 1 < len(chunks):
+            pending = asyncio.ensure_future(encode(chunks[n + 1]))
+        start = n * SEARCH_BATCH_CHUNK
+        ok    = [i for i, vec in enumerate(vecs) if not isinstance(vec, Exception)]
+        found = dict(zip(ok, await search_many([(vecs[i], *params[start + i]) for i in ok])))
+        for i, vec in enumerate(vecs):
+            result = vec if isinstance(vec, Exception) else found[i]
+            if isinstance(result, Exception):
+                yield {"index": start + i, "error": str(result)}
+                continue
+            if exclude is not None:
+                result = without_self(result, exclude[start + i], params[start + i][0] - 1)
+            yield {"index": start + i, "hits": public_hits(result)}
+
 
-    hits = knn_search(
-        es, index=ES_INDEX, vector=vec,
-        k=k, candidates=NUM_CANDIDATES,
-        source_fields=["path"]        # adjust if you index more meta-data
-    )
+async def batch_response(rows, stream: bool):
+    if stream:
+        async def ndjson():
+            async for row in rows:
+                yield json.dumps(row) + "\n"
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    return JSONResponse([row async for row in rows])
+
+
+# -------------------------- filters / paging --------------------------------------
+# Metadata filters run inside the kNN query (ES pre-filter), so a selective
+# query costs no more than an unfiltered one. Pages come from a cursor that
+# rebuilds the query vector without re-encoding, on whichever worker gets it.
+def parse_filters(raw: str | None) -> dict | None:
+    """The `filters` query parameter: a JSON object as in TextQuery.filters."""
+    if not raw:
+        return None
+    try:
+        spec = json.loads(raw)
+        if not isinstance(spec, dict):
+            raise ValueError("filters must be a JSON object")
+        return filters.normalize(spec)
+    except ValueError as exc:
+        raise HTTPException(422, f"Bad filters: {exc}")
+
+
+async def page_response(
+    vec: list[float], k: int, candidates: int | None, spec: dict | None,
+    offset: int = 0, text: str | None = None,
+) -> JSONResponse:
+    """
+    One page of public hits; X-Next-Cursor points at the next one while
+    there is more. `text` is the prompt of a text query.
+    """
+    candidates = candidates or NUM_CANDIDATES
+    with metrics.stage("knn"):
+        hits = await search_vector(vec, k, candidates, spec, offset)
+    with metrics.stage("serialize"):
+        response = JSONResponse(public_hits(hits))
+    if len(hits) == k and offset + 2 * k <= MAX_RESULT_WINDOW:
+        cursor = Cursor(offset + k, k, candidates, spec, text, None if text is not None else vec)
+        response.headers["X-Next-Cursor"] = cursor.encode()
+    return response
+
+
+# -------------------------- more like this ----------------------------------------
+# An indexed image already has its vector in the store: fetch it by id
+# instead of re-uploading and re-encoding the picture.
+async def stored_vectors(ids: list[str]) -> list[list[float] | Exception]:
+    found   = {i: vector_cache.get(i) for i in ids}
+    missing = [i for i, vec in found.items() if vec is None]
+    if missing:
+        with metrics.stage("vector_fetch", len(missing)):
+            fetched = await store.get_vectors_async(missing)
+        for i, vec in fetched.items():
+            vector_cache.put(i, vec)
+            found[i] = vec
+    return [found[i] if found[i] is not None else LookupError(f"No indexed image with id {i}") for i in ids]
+
+
+def without_self(hits: list[dict], doc_id: str, k: int) -> list[dict]:
+    """Drop the query image from its own neighbours (searched with k + 1)."""
+    return [h for h in hits if h["id"] != doc_id][:k]
+
+
+def public_hits(hits: list[dict]) -> list[dict]:
+    """Replace internal paths with public /images and /thumbs URLs (returns new dicts)."""
+    out = []
     for h in hits:
-        filename = Path(h["path"]).name          # strip /data/images/…
-        h["url"]  = f"/images/{filename}"        # add public URL
-        del h["path"]                            # optional: hide internals
+        name = Path(h["path"]).name                                  # strip /data/images/…
+        pub = {key: val for key, val in h.items() if key != "path"}  # hide internals
+        pub["url"]   = f"/images/{name}"
+        pub["thumb"] = f"/thumbs/{name}"
+        out.append(pub)
+    return out
+
+
+@app.on_event("startup")
+async def startup():
+    app.state.index_watcher = asyncio.create_task(watch_index())
+
 
-    return JSONResponse(hits)
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.index_watcher.cancel()
+    await store.close_async()
+    model_pool.shutdown(wait=False)
+
+
+# ─────────────────────────── ROUTES ──────────────────────────
+@app.post("/search/text")
+async def search_text(body: TextQuery):
+    """
+    Encode user prompt → CLIP vector → k-NN in the vector store, optionally
+    pre-filtered on metadata. X-Next-Cursor (if present) → /search/page.
+    """
+    k = body.k or TOP_K_DEFAULT
+    with metrics.stage("encode"):
+        vec = await embed_text(body.text)
+    return await page_response(vec, k, body.num_candidates, body.filters, text=body.text)
 
 
 @app.post("/search/image")
-async def search_image(file: UploadFile, k: int = TOP_K_DEFAULT):
+async def search_image(
+    file: UploadFile,
+    k: int = Query(TOP_K_DEFAULT, ge=1, le=MAX_RESULT_WINDOW),
+    num_candidates: int | None = Query(None, ge=1, le=10_000),
+    filter_json: str | None = Query(None, alias="filters", description="JSON metadata filter, as in /search/text"),
+):
     """
-    Upload an image (any common type). Returns k most similar images.
+    Upload an image (any common type). Returns k most similar images;
+    paging and filters as in /search/text.
     """
     if file.content_type.split("/")[0] != "image":
         raise HTTPException(400, "Uploaded file must be an image")
+    spec = parse_filters(filter_json)
 
     img_bytes = await file.read()
-    vec       = encoder.image(img_bytes)
+    with metrics.stage("encode"):
+        vec = await run_model(encoder.image, img_bytes)
+    return await page_response(vec, k, num_candidates, spec)
 
-    hits = knn_search(
-        es, index=ES_INDEX, vector=vec,
-        k=k, candidates=NUM_CANDIDATES,
-        source_fields=["path"]
-    )
-    for h in hits:
-        filename = Path(h["path"]).name          # strip /data/images/…
-        h["url"]  = f"/images/{filename}"        # add public URL
-        del h["path"]                            # optional: hide internals
 
-    return JSONResponse(hits)
+@app.get("/search/page")
+async def search_page(cursor: str):
+    """Next page of a /search/text or /search/image query (X-Next-Cursor)."""
+    try:
+        cur  = Cursor.decode(cursor)
+        spec = filters.normalize(cur.spec)
+    except ValueError as exc:
+        raise HTTPException(400, str(exc))
+    if not (0 < cur.k and 0 <= cur.offset <= MAX_RESULT_WINDOW - cur.k
+            and 0 < cur.candidates <= 10_000):
+        raise HTTPException(400, "Cursor out of range")
+    if cur.text is None and len(cur.vector) != encoder.embed_dim:
+        raise HTTPException(400, "Cursor vector has the wrong dimension")
+    if cur.text is not None:
+        with metrics.stage("encode"):
+            vec = await embed_text(cur.text)
+    else:
+        vec = cur.vector
+    return await page_response(vec, cur.k, cur.candidates, spec, cur.offset, cur.text)
+
+
+@app.post("/search/text/batch")
+async def search_text_batch(body: TextBatchQuery):
+    """
+    Many prompts in one request. Returns one row per query, in order:
+    {"index", "hits"} or {"index", "error"}; NDJSON when `stream` is set.
+    """
+    params = [(q.k or TOP_K_DEFAULT, q.num_candidates or NUM_CANDIDATES, q.filters) for q in body.queries]
+    rows   = batch_rows([q.text for q in body.queries], embed_texts, params)
+    return await batch_response(rows, body.stream)
+
+
+@app.post("/search/image/batch")
+async def search_image_batch(
+    files: list[UploadFile],
+    k: int = Query(TOP_K_DEFAULT, ge=1, le=MAX_RESULT_WINDOW),
+    num_candidates: int | None = Query(None, ge=1, le=10_000),
+    stream: bool = False,
+):
+    """
+    Upload many images; same k for each. Rows as in /search/text/batch – a
+    file that is not a decodable image gets an "error" row.
+    """
+    if len(files) > SEARCH_BATCH_MAX:
+        raise HTTPException(413, f"At most {SEARCH_BATCH_MAX} images per batch")
+    blobs: list[bytes | Exception] = []
+    for f in files:
+        if (f.content_type or "").split("/")[0] != "image":
+            blobs.append(ValueError(f"{f.filename}: not an image"))
+        else:
+            blobs.append(await f.read())
+    params = [(k, num_candidates or NUM_CANDIDATES)] * len(blobs)
+    rows   = batch_rows(blobs, lambda chunk: run_model(encode_uploads, chunk), params)
+    return await batch_response(rows, stream)
+
+@app.get("/search/similar/{doc_id}")
+async def search_similar(
+    doc_id: str,
+    k: int = Query(TOP_K_DEFAULT, ge=1, le=MAX_RESULT_WINDOW - 1),   # +1 for the image itself
+    num_candidates: int | None = Query(None, ge=1, le=10_000),
+):
+    """
+    "More like this" for an indexed image (its `id` in any result): reuses
+    the stored vector, no model inference. The image itself is excluded.
+    """
+    with metrics.stage("encode"):
+        vec = (await stored_vectors([doc_id]))[0]
+    if isinstance(vec, Exception):
+        raise HTTPException(404, str(vec))
+    with metrics.stage("knn"):
+        hits = await search_vector(vec, k + 1, num_candidates)
+    with metrics.stage("serialize"):
+        return JSONResponse(public_hits(without_self(hits, doc_id, k)))
+
+
+@app.post("/search/similar/batch")
+async def search_similar_batch(body: SimilarBatchQuery):
+    """Many ids in one request; rows as in /search/text/batch."""
+    k      = body.k or TOP_K_DEFAULT
+    params = [(k + 1, body.num_candidates or NUM_CANDIDATES)] * len(body.ids)
+    rows   = batch_rows(body.ids, stored_vectors, params, exclude=body.ids)
+    return await batch_response(rows, body.stream)
 
 app.mount(
     "/images",
-    StaticFiles(directory="/data/images"),
+    StaticFiles(directory=IMAGES_DIR),
     name="images",
 )
 
+@app.get("/thumbs/{name}")
+async def thumb(request: Request, name: str, w: int = Query(256, ge=16, le=4096)):
+    """
+    Resized copy of /images/{name}, at most `w` px wide (snapped to
+    THUMB_WIDTHS). WebP when the client accepts it, JPEG otherwise.
+    """
+    src = thumbs.source_path(name)
+    if src is None:
+        raise HTTPException(404, "No such image")
+
+    width = thumbs.snap_width(w)
+    fmt   = "webp" if "image/webp" in request.headers.get("accept", "") else "jpeg"
+    tag   = thumbs.etag(src, width, fmt)
+    headers = {
+        "ETag":          tag,
+        "Cache-Control": f"public, max-age={THUMB_MAX_AGE}",
+        "Vary":          "Accept",
+    }
+    if request.headers.get("if-none-match") == tag:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        path = await asyncio.to_thread(thumbs.thumbnail, src, width, fmt)
+    except OSError as exc:                     # undecodable / truncated source
+        raise HTTPException(422, f"Cannot thumbnail {name}: {exc}")
+    return FileResponse(path, media_type=thumbs.FORMATS[fmt][1], headers=headers)
+
 @app.get("/meta")
 async def meta() -> dict:
-    info   = es.info()
-    health = es.cluster.health()
-    count  = es.count(index=ES_INDEX)["count"]
+    info = await store.info_async()
 
     return {
-        "model_name":  os.getenv("MODEL", "RN50"),
+        "model_name":  MODEL,
         "vector_dim":  encoder.embed_dim,
-        "device":      str(next(iter(encoder.model.parameters())).device),
-        "es_version":  info["version"]["number"],
+        "device":      str(encoder.device),
+        "towers":      encoder.towers,
+        "encoder":     encoder.backend,
+        "backend":     info["backend"],
+        "es_version":  info["version"],
         "es_index":    ES_INDEX,
-        "doc_count":   count,
-        "hnsw_m":      16,
-        "hnsw_ef":     512,
-        "cluster":     health["status"],
+        "doc_count":   info["doc_count"],
+        "index_type":  info["index_options"].get("type"),
+        "hnsw_m":      info["index_options"].get("m"),
+        "hnsw_ef":     info["index_options"].get("ef_construction"),
+        "cluster":     info["status"],
+        "cache": {
+            "text":   text_cache.stats(),
+            "result": result_cache.stats(),
+        },
     }
 
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.latest(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+
 @app.get("/healthz")
 async def healthz():
     return {"status": "ok"}
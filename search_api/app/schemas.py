@@ -1,5 +1,35 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
+
+from common import filters
+from .config import SEARCH_BATCH_MAX, MAX_RESULT_WINDOW
 
 class TextQuery(BaseModel):
     text: str = Field(..., description="Free‑text prompt")
-    k: int | None = Field(None, description="How many images (optional)")
+    k: int | None = Field(None, ge=1, le=MAX_RESULT_WINDOW, description="How many images (optional)")
+    num_candidates: int | None = Field(
+        None, ge=1, le=10_000,
+        description="HNSW candidates per shard (optional, defaults to NUM_CANDIDATES)",
+    )
+    filters: dict | None = Field(
+        None,
+        description='Metadata pre-filter, e.g. {"domain": ["example.com"], "width": {"gte": 512}}',
+    )
+
+    @field_validator("filters")
+    @classmethod
+    def _check_filters(cls, spec):
+        return filters.normalize(spec)
+
+
+class TextBatchQuery(BaseModel):
+    queries: list[TextQuery] = Field(..., min_length=1, max_length=SEARCH_BATCH_MAX)
+    stream: bool = Field(False, description="Stream NDJSON rows as each chunk completes")
+
+
+class SimilarBatchQuery(BaseModel):
+    ids: list[str] = Field(..., min_length=1, max_length=SEARCH_BATCH_MAX, description="Indexed image ids")
+    k: int | None = Field(
+        None, ge=1, le=MAX_RESULT_WINDOW - 1, description="How many images per id (optional)",
+    )
+    num_candidates: int | None = Field(None, ge=1, le=10_000)
+    stream: bool = Field(False, description="Stream NDJSON rows as each chunk completes")
@@ -0,0 +1,143 @@
+"""
+Serve the search API from several processes that share one model copy.
+
+With SEARCH_WORKERS > 1 the parent imports app.main – loading the CLIP
+weights and opening the vector store – binds the listening socket, then
+forks the workers. Weight tensors live in their own allocations and are
+never written after loading, so the children share them copy-on-write and
+resident memory stays close to a single model; gc.freeze() keeps the
+collector from touching (and so copying) the preloaded objects. Everything
+bound to sockets or an event loop (async ES client, batchers' timers,
+executor threads) is created lazily, i.e. in each child.
+
+Threads: each worker runs up to INFERENCE_WORKERS forward passes at once,
+so unless INTRA_OP_THREADS is set every pass gets
+cores / (workers × INFERENCE_WORKERS) torch (and BLAS) threads and the CPU
+is not oversubscribed. The parent loads with a single thread – an OpenMP
+pool started before fork() would hang the children.
+
+ENCODER_BACKEND=onnx cannot be preloaded (ONNX Runtime sessions own thread
+pools that do not survive a fork), so there each worker loads its own copy;
+the parent only exports the ONNX graphs first, so the workers do not all
+export them at once.
+
+Metrics: the workers share PROMETHEUS_MULTIPROC_DIR (a temp dir unless set)
+and /metrics on any of them reports the sum. Caches are per worker.
+A worker that dies is replaced by a fresh fork of the parent.
+
+Usage (the search-api image's default command)
+-----
+SEARCH_WORKERS=8 python -m app.serve
+"""
+import gc, logging, os, shutil, signal, socket, sys, tempfile, time
+
+from .config import SEARCH_WORKERS, SEARCH_HOST, SEARCH_PORT, INFERENCE_WORKERS
+
+
+def budget(workers: int) -> str:
+    """Intra-op threads per forward pass, unless INTRA_OP_THREADS says otherwise."""
+    passes = workers * max(INFERENCE_WORKERS, 1)
+    return os.getenv("INTRA_OP_THREADS") or str(max((os.cpu_count() or passes) // passes, 1))
+
+
+def run_worker(sock: socket.socket, threads: int):
+    """Child: own thread budget, then serve on the inherited socket."""
+    import torch, uvicorn
+    torch.set_num_threads(threads)
+    from .main import app                     # already imported unless onnx
+    uvicorn.Server(uvicorn.Config(app, lifespan="on")).run(sockets=[sock])
+
+
+def main() -> int:
+    n = max(SEARCH_WORKERS, 1)
+    if n == 1:
+        import uvicorn
+        uvicorn.run("app.main:app", host=SEARCH_HOST, port=SEARCH_PORT)
+        return 0
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s  %(levelname)-8s %(message)s")
+    threads = budget(n)
+    preload = os.getenv("ENCODER_BACKEND", "torch") != "onnx"
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ.setdefault(var, threads)
+    os.environ["INTRA_OP_THREADS"] = "1" if preload else threads
+
+    # must be set before prometheus_client is first imported
+    prom_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="prometheus-"))
+    shutil.rmtree(prom_dir, ignore_errors=True)
+    os.makedirs(prom_dir, exist_ok=True)
+    from prometheus_client import multiprocess
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((SEARCH_HOST, SEARCH_PORT))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    import uvicorn                           # noqa: F401 – imported once, before fork
+    if preload:
+        from . import main as _preloaded     # noqa: F401 – weights + store, shared below
+        gc.collect()
+        gc.freeze()
+    else:
+        import torch
+        from common.models import encoder, export_onnx
+        torch.set_num_threads(1)             # see above: no OpenMP pool before fork
+        towers = os.getenv("ENCODER_TOWERS", "both")
+        for tower in ("image", "text"):
+            if towers in ("both", tower):
+                export_onnx(encoder.name, tower)
+
+    children: dict[int, int] = {}            # pid → worker number
+
+    def spawn(i: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(sock, int(threads))
+            except BaseException:
+                logging.exception("Worker %d crashed", i)
+                code = 1
+            os._exit(code)
+        children[pid] = i
+        logging.info("Started worker %d (pid %d, %s thread(s))", i, pid, threads)
+
+    for i in range(n):
+        spawn(i)
+    logging.info(
+        "Serving on %s:%d with %d workers (%s)", SEARCH_HOST, SEARCH_PORT, n,
+        "shared preloaded model" if preload else "one model per worker",
+    )
+
+    stopping = False
+
+    def forward(signum, _frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signum)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        i = children.pop(pid, None)
+        multiprocess.mark_process_dead(pid)
+        if i is None or stopping:
+            continue
+        logging.warning("Worker %d (pid %d) exited with %d – replacing it",
+                        i, pid, os.waitstatus_to_exitcode(status))
+        time.sleep(1)                         # no hot crash loop
+        if not stopping:
+            spawn(i)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Resized thumbnails for result grids, cached on disk.
+
+Requested widths are snapped up to one of THUMB_WIDTHS so the cache stays
+bounded; JPEG sources are decoded in draft mode (DCT scaling) to roughly
+the target size first. A cached file is reused until its source changes.
+
+thumbnail() is blocking (Pillow) – call it from a worker thread.
+"""
+from __future__ import annotations
+
+import os, threading
+from pathlib import Path
+
+from PIL import Image
+
+from .config import IMAGES_DIR, THUMB_DIR, THUMB_WIDTHS, THUMB_QUALITY
+
+FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+
+
+def snap_width(w: int) -> int:
+    """Smallest configured width ≥ w (the largest one if w is bigger)."""
+    return next((s for s in THUMB_WIDTHS if s >= w), THUMB_WIDTHS[-1])
+
+
+def source_path(name: str) -> Path | None:
+    """Original image for a public name, or None if it is not a plain, visible file."""
+    if not name or name != Path(name).name or name.startswith("."):
+        return None
+    src = IMAGES_DIR / name
+    return src if src.is_file() else None
+
+
+def etag(src: Path, width: int, fmt: str) -> str:
+    st = src.stat()
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}-{width}-{fmt}"'
+
+
+def thumbnail(src: Path, width: int, fmt: str) -> Path:
+    """Path of the cached `fmt` thumbnail of `src`, `width` px wide at most."""
+    out = THUMB_DIR / str(width) / f"{src.stem}.{fmt}"
+    try:
+        if out.stat().st_mtime_ns >= src.stat().st_mtime_ns:
+            return out
+    except FileNotFoundError:
+        pass
+
+    with Image.open(src) as img:
+        img.draft("RGB", (width, width))
+        img = img.convert("RGB")
+        if img.width > width:
+            img = img.resize((width, max(round(img.height * width / img.width), 1)), Image.BICUBIC)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        # per-thread temp name: concurrent requests for the same thumbnail
+        # each write their own copy, the last rename wins
+        tmp = out.with_name(f".{out.name}.{os.getpid()}.{threading.get_ident()}.part")
+        try:
+            img.save(tmp, FORMATS[fmt][0], quality=THUMB_QUALITY)
+            os.replace(tmp, out)
+        finally:
+            tmp.unlink(missing_ok=True)
+    return out
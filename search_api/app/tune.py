@@ -0,0 +1,103 @@
+"""
+ANN recall / latency sweep for NUM_CANDIDATES.
+
+Samples query vectors (stored image vectors and/or encoded prompts), takes
+exact cosine top-k from a brute-force `script_score` query as ground truth,
+then runs the regular kNN query for every `num_candidates` in the sweep and
+reports recall@k plus p50/p95/p99 latency.
+
+Usage (inside the search-api container)
+-----
+python -m app.tune --k 10 --candidates 10,25,50,100,200,400 --samples 200
+python -m app.tune --prompts prompts.txt --json results.json
+"""
+from __future__ import annotations
+
+import argparse, json, sys, time
+
+import numpy as np
+
+from common.es_utils import (
+    ES_INDEX, get_es_client, knn_search, exact_search, sample_vectors,
+)
+from .config import TOP_K_DEFAULT
+
+
+def load_queries(es, args) -> list[tuple[str, list[float]]]:
+    queries: list[tuple[str, list[float]]] = []
+    if args.samples:
+        queries += sample_vectors(es, ES_INDEX, args.samples, seed=args.seed)
+    if args.prompts:
+        from common.models import encoder           # only load CLIP when needed
+        prompts = [p.strip() for p in open(args.prompts) if p.strip()]
+        queries += list(zip(prompts, encoder.text(prompts)))
+    return queries
+
+
+def sweep(es, queries, k: int, candidates: list[int]) -> list[dict]:
+    truth = [
+        {h["id"] for h in exact_search(es, ES_INDEX, vec, k=k)}
+        for _, vec in queries
+    ]
+    rows = []
+    for nc in candidates:
+        recalls, lat_ms = [], []
+        for (_, vec), exact in zip(queries, truth):
+            t0 = time.perf_counter()
+            hits = knn_search(es, ES_INDEX, vec, k=k, candidates=max(nc, k))
+            lat_ms.append((time.perf_counter() - t0) * 1000)
+            recalls.append(len(exact & {h["id"] for h in hits}) / max(len(exact), 1))
+        p50, p95, p99 = np.percentile(lat_ms, [50, 95, 99])
+        rows.append({
+            "num_candidates": nc,
+            "recall_at_k":    round(float(np.mean(recalls)), 4),
+            "p50_ms":         round(float(p50), 2),
+            "p95_ms":         round(float(p95), 2),
+            "p99_ms":         round(float(p99), 2),
+        })
+    return rows
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--k", type=int, default=TOP_K_DEFAULT)
+    ap.add_argument("--candidates", default="10,25,50,100,200,400",
+                    help="comma-separated num_candidates values to sweep")
+    ap.add_argument("--samples", type=int, default=100,
+                    help="stored image vectors to use as queries (0 = none)")
+    ap.add_argument("--prompts", help="file with one text prompt per line")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--target", type=float, default=0.95,
+                    help="recall@k the suggested setting must reach")
+    ap.add_argument("--json", help="also write the results to this file")
+    args = ap.parse_args(argv)
+
+    es = get_es_client()
+    queries = load_queries(es, args)
+    if not queries:
+        print("no queries – index is empty and no --prompts given", file=sys.stderr)
+        return 1
+
+    candidates = sorted(int(c) for c in args.candidates.split(","))
+    rows = sweep(es, queries, args.k, candidates)
+
+    print(f"{len(queries)} queries, k={args.k}, index={ES_INDEX}")
+    print(f"{'num_candidates':>14} {'recall@k':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for r in rows:
+        print(f"{r['num_candidates']:>14} {r['recall_at_k']:>9.4f} "
+              f"{r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+
+    ok = [r for r in rows if r["recall_at_k"] >= args.target]
+    if ok:
+        print(f"→ cheapest setting with recall ≥ {args.target}: NUM_CANDIDATES={ok[0]['num_candidates']}")
+    else:
+        print(f"→ no setting reached recall {args.target}; extend --candidates")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"k": args.k, "queries": len(queries), "index": ES_INDEX, "results": rows}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
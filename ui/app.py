@@ -1,17 +1,55 @@
 import os, requests, time
 import streamlit as st
-from io import BytesIO
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 
 API_URL = os.getenv("API_URL", "http://search-api:8000")
 TOP_K_DEFAULT = int(os.getenv("TOP_K", 10))
 MODEL     = os.getenv("MODEL",     "RN50")
 ES_INDEX  = os.getenv("ES_INDEX",  "images")
+THUMB_WIDTH = int(os.getenv("UI_THUMB_WIDTH", 256))
+FETCH_WORKERS = 8
+
+# one pooled session for every call to the API (keep-alive instead of a
+# new TCP connection per image)
+http = requests.Session()
+http.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=FETCH_WORKERS))
+
+
+# ───────────────────────── cached API calls ─────────────────────────
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_meta() -> dict:
+    return http.get(f"{API_URL}/meta", timeout=5).json()
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def search_text(query: str, k: int) -> list[dict]:
+    resp = http.post(f"{API_URL}/search/text", json={"text": query, "k": k}, timeout=20)
+    if not resp.ok:
+        raise RuntimeError(f"Error {resp.status_code}: {resp.text}")
+    return resp.json()
+
+
+@st.cache_data(ttl=3600, max_entries=2000, show_spinner=False)
+def fetch_thumb(path: str) -> bytes:
+    resp = http.get(f"{API_URL}{path}", params={"w": THUMB_WIDTH}, timeout=20)
+    resp.raise_for_status()
+    return resp.content
+
+
+def fetch_thumbs(hits: list[dict]) -> list[bytes | None]:
+    """Download every result thumbnail concurrently; None where one failed."""
+    def one(h):
+        try:
+            return fetch_thumb(h.get("thumb", h["url"]))
+        except Exception:
+            return None
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        return list(pool.map(one, hits))
 
 # ───────────────────────── sidebar “About” panel ─────────────────────────
 with st.sidebar.expander("🔧 Runtime info", expanded=False):
     try:
-        meta = requests.get(f"{API_URL}/meta", timeout=5).json()
+        meta = fetch_meta()
     except Exception as e:
         st.error(f"Meta fetch failed: {e}")
     else:
@@ -23,7 +61,7 @@ with st.sidebar.expander("🔧 Runtime info", expanded=False):
             **ES index**: `{meta['es_index']}`  
             **Docs**: `{meta['doc_count']}`  
             **ES v**: `{meta['es_version']}` ({meta['cluster']})  
-            **HNSW**: m={meta['hnsw_m']} ef={meta['hnsw_ef']}
+            **Index**: `{meta.get('index_type')}` m={meta['hnsw_m']} ef={meta['hnsw_ef']}
             """
         )
 
@@ -41,20 +79,20 @@ with st.form(key="search_form"):
 if submitted and query:
     t0 = time.time()
     with st.spinner("Querying…"):
-        resp = requests.post(
-            f"{API_URL}/search/text",
-            json={"text": query, "k": k},
-            timeout=20,
-        )
-    if resp.ok:
-        hits = resp.json()
+        try:
+            hits = search_text(query, k)
+        except Exception as e:
+            st.error(str(e))
+            hits = None
+    search_ms = (time.time() - t0) * 1000
+    if hits is not None:
+        thumbs = fetch_thumbs(hits)
         cols = st.columns(4)
-        for i, h in enumerate(hits):
+        for i, (h, data) in enumerate(zip(hits, thumbs)):
             col = cols[i % 4]
-            img_resp = requests.get(f"{API_URL}{h['url']}", timeout=20)
-            img = Image.open(BytesIO(img_resp.content))
-            col.image(img, caption=f"{h['score']:.3f}")
-    else:
-        st.error(f"Error {resp.status_code}: {resp.text}")
-    latency_ms = (time.time() - t0) * 1000
-    st.write(f"⏱️ {latency_ms:.1f} ms")
+            if data is None:
+                col.warning(f"{h['score']:.3f} – image unavailable")
+            else:
+                col.image(data, caption=f"{h['score']:.3f}")
+    total_ms = (time.time() - t0) * 1000
+    st.write(f"⏱️ search {search_ms:.1f} ms · total {total_ms:.1f} ms")